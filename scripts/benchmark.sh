@@ -0,0 +1,15 @@
+#!/bin/bash
+# writes benchmark results to the first argument, failing if anything is slower than the baseline json in the second
+OUT_PATH=${1:-midas-benchmark.json}
+BASELINE_PATH=${2:-}
+python - "$OUT_PATH" "$BASELINE_PATH" <<'PY'
+import sys
+import multiprocessing
+import src.benchmark as benchmark
+
+if __name__ == "__main__":
+	multiprocessing.freeze_support()
+	baseline_path = sys.argv[2] if sys.argv[2] != "" else None
+	regressions = benchmark.main(sys.argv[1], baseline_path)
+	assert len(regressions) == 0, f"{len(regressions)} benchmarks regressed"
+PY
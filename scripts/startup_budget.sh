@@ -0,0 +1,18 @@
+#!/bin/bash
+# fails if loading the cli imports the download stack or takes longer than the budget in seconds
+BUDGET=${1:-0.5}
+python - "$BUDGET" <<'PY'
+import sys
+import time
+
+budget = float(sys.argv[1])
+start_tick = time.perf_counter()
+import src
+duration = time.perf_counter() - start_tick
+
+heavy_modules = [name for name in ["pandas", "numpy", "midas", "azure.kusto.data", "keyring", "pyarrow"] if name in sys.modules]
+print(f"cli import took {round(duration*1000)}ms, budget is {round(budget*1000)}ms")
+
+assert len(heavy_modules) == 0, f"cli import loaded {', '.join(heavy_modules)}"
+assert duration < budget, "cli import is over budget"
+PY
@@ -1,17 +1,15 @@
-import sys
 import os
-import keyring
 import multiprocessing
-import pandas as pd
-from pandas import DataFrame
-import midas.playfab as playfab
-import midas.data_encoder as data_encoder
-from midas.playfab import PlayFabClient
+from argparse import ArgumentParser, Namespace
+from typing import TYPE_CHECKING, Callable, TypedDict
 import src.config as config
-import src.treecode as treecode
-import src.build as build
 from src.config import CREDENTIAL_USERNAME
 
+# heavy modules are imported by the commands that need them so the rest of the cli starts quickly
+if TYPE_CHECKING:
+	from pandas import DataFrame
+	from src.export import OutputFormat
+
 # constants
 INIT_TAG = "init"
 BUILD_LUAU_TAG = "build"
@@ -21,120 +19,427 @@ AUTH_ROBLOX_TAG = "auth-roblox"
 AUTH_ALL_TAG = "auth"
 CLEAN_TAG = "clean"
 DOWNLOAD_TAG = "download"
+ENCODING_REPORT_TAG = "encoding-report"
+MOCK_SERVER_TAG = "mock-server"
+DECODE_TAG = "decode"
 RAW_TAG = "-raw"
+STREAM_TAG = "-stream"
+WORKERS_TAG = "-workers"
+FORMAT_TAG = "-format"
+RESUME_TAG = "-resume"
+SINCE_LAST_TAG = "-since-last"
+FORCE_TAG = "-force"
+SERIAL_TAG = "-serial"
+PROFILE_TAG = "-profile"
+SIZES_TAG = "-sizes"
+SAMPLE_TAG = "-sample"
+TOP_TAG = "-top"
+ENDPOINT_TAG = "-endpoint"
+CONCURRENCY_TAG = "-concurrency"
+PORT_TAG = "-port"
+USERS_TAG = "-users"
+EVENTS_PER_USER_TAG = "-events-per-user"
+DAYS_TAG = "-days"
+LATENCY_TAG = "-latency"
+MAX_ROWS_TAG = "-max-rows"
+MAX_CONCURRENT_TAG = "-max-concurrent"
+SEED_TAG = "-seed"
+NO_CACHE_TAG = "-no-cache"
+SELECT_TAG = "-select"
+EVENT_TAG = "-event"
+SLICE_TAG = "-slice"
+LIST_TAG = "-list"
+
+def download(
+	out_path: str,
+	download_start_data: str,
+	download_window: int,
+	user_limit: int,
+	is_raw: bool,
+	is_stream: bool=False,
+	worker_count: int | None=None,
+	output_format: "OutputFormat"="json",
+	is_resume: bool=False,
+	is_since_last: bool=False,
+	endpoint: str | None=None,
+	concurrency: int | None=None,
+	is_cached: bool=True,
+	selectors: list[str] | None=None,
+	event_names: list[str] | None=None
+) -> "DataFrame | None":
+	from pandas import DataFrame
+	import midas.playfab as playfab
+	from midas.playfab import PlayFabClient
+	import src.treecode as treecode
+	import src.stream as stream
+	import src.decode as decode
+	import src.export as export
+	import src.watermark as watermark
+	import src.pagecache as pagecache
+	import src.projection as projection
+
+	if worker_count == None:
+		worker_count = decode.DEFAULT_WORKER_COUNT
+
+	if concurrency == None:
+		concurrency = stream.DEFAULT_CONCURRENCY
+
+	abs_out_path = os.path.abspath(out_path)
+
+	# typed columns are only known once the events are decoded
+	midas_config = None
+	if not is_raw and output_format != "json" and output_format != "ndjson":
+		midas_config = config.get_midas_config()
 
-def download(json_path: str, download_start_data: str, download_window: int, user_limit: int, is_raw: bool):
-	abs_json_path = os.path.abspath(json_path)
+	if selectors == None:
+		selectors = []
+	if event_names == None:
+		event_names = []
+
+	# selected paths are fetched under the codes from midas.cache, so only they cross the wire
+	selection = None
+	if len(selectors) > 0 or len(event_names) > 0:
+		selection = projection.get_selection(selectors, event_names, config.get_midas_config(), treecode.get_encoding_history())
+		print(f"only downloading {', '.join(selection['paths']) or 'every path'} for {', '.join(selection['event_names']) or 'every event'}")
+
+	pf_client: PlayFabClient
+	if endpoint != None:
+		from src.mock_playfab import LocalPlayFabClient
+		pf_client = LocalPlayFabClient(endpoint)
+	else:
+		import src.auth as auth
+		pf_client = auth.get_playfab_client(auth.get_cached_auth_config())
+
+	# every fetched page is kept so it can be decoded again later without downloading it
+	page_cache = None
+	if is_cached:
+		page_cache = pagecache.PageCache()
+
+	# resuming and incremental downloads rely on the page-by-page progress kept by streaming
+	if is_stream or is_resume or is_since_last:
+		encoding_index = None
+		if not is_raw:
+			encoding_index = treecode.get_encoding_history()
+
+		store = watermark.WatermarkStore()
+		stream.download_to_file(
+			pf_client,
+			abs_out_path,
+			user_join_floor=playfab.get_datetime_from_playfab_str(download_start_data),
+			join_window_in_days=download_window,
+			user_limit=user_limit,
+			encoding_index=encoding_index,
+			worker_count=worker_count,
+			output_format=output_format,
+			midas_config=midas_config,
+			store=store,
+			is_resume=is_resume,
+			is_since_last=is_since_last,
+			concurrency=concurrency,
+			page_cache=page_cache,
+			selection=selection
+		)
+		store.close()
+		if page_cache != None:
+			page_cache.close()
+		return None
+
+	user_join_floor = playfab.get_datetime_from_playfab_str(download_start_data)
+	pages = stream.iterate_event_pages(
+		pf_client,
+		user_join_floor=user_join_floor,
+		join_window_in_days=download_window,
+		user_limit=user_limit,
+		concurrency=concurrency,
+		selection=selection
+	)
+	if page_cache != None:
+		slice_key = pagecache.get_slice_key(pf_client.title_id, user_join_floor, download_window, user_limit, selection=selection)
+		page_cache.start_slice(slice_key, pf_client.title_id, user_join_floor, download_window, user_limit)
+		pages = pagecache.iterate_cached_pages(pages, page_cache, slice_key)
 
-	# midas_config = config.get_midas_config()
+	events = []
+	for _, page in pages:
+		events.extend(page)
 
-	auth_config = config.get_auth_config()
-	pf_auth_config = auth_config["playfab"]
-	aad_auth_config = auth_config["aad"]
+	if page_cache != None:
+		page_cache.close()
 
-	pf_client = PlayFabClient(
-		client_id = aad_auth_config["client_id"],
-		client_secret = aad_auth_config["client_secret"],
-		tenant_id = aad_auth_config["tenant_id"],
-		title_id = pf_auth_config["title_id"]
-	)
-	df = DataFrame(pf_client.download_all_event_data(
-		user_join_floor=playfab.get_datetime_from_playfab_str(download_start_data),
-		join_window_in_days=download_window,
-		user_limit= user_limit
-	))
+	print(f"\nreturning {len(events)} events")
+	df = DataFrame(events)
+
+	if not is_raw and midas_config != None:
+		print("decoding to typed columns")
+		writer = export.get_writer(abs_out_path, output_format, midas_config, paths=selection["paths"] if selection != None else None)
+		assert isinstance(writer, export.ArrowWriter)
+		typed_df = decode.decode_typed_df(df, treecode.get_encoding_history(), writer.column_types, worker_count)
 
-	if not is_raw:
+		print(f"writing to {output_format}")
+		writer.write_typed(typed_df)
+		writer.close()
+
+		return typed_df
+	elif not is_raw:
 		print("decoding")
-		decoded_df = data_encoder.decode_raw_df(df, treecode.get_tree_encoding())
+		decoded_df = decode.decode_raw_df(df, treecode.get_encoding_history(), worker_count)
 
-		print("writing to json")
-		decoded_df.to_json(abs_json_path, indent=4, orient="records")
+		print(f"writing to {output_format}")
+		export.write_df(decoded_df, abs_out_path, output_format, midas_config)
 		
 		return decoded_df
 	else:
-		print("writing raw to json")
-		df.to_json(abs_json_path, indent=4, orient="records")
+		print(f"writing raw to {output_format}")
+		export.write_df(df, abs_out_path, output_format)
 
 		return df
 
-def main():
-	# parse command
-	assert len(sys.argv) > 1, "no arguments provided"
-
-	if sys.argv[1] == INIT_TAG:
-
-		config.init_file()
-
-	elif sys.argv[1] == BUILD_LUAU_TAG: 
-
-		treecode.set_tree_encoding()
-		if len(sys.argv) > 2:
-			keyring.set_password("title_id", CREDENTIAL_USERNAME, sys.argv[2])
-			keyring.set_password("dev_secret_key", CREDENTIAL_USERNAME, sys.argv[3])
-
-		build.main()
-
-	elif sys.argv[1] == AUTH_PLAYFAB_TAG:
-
-		keyring.set_password("title_id", CREDENTIAL_USERNAME, input("playfab title id: "))
-		keyring.set_password("dev_secret_key", CREDENTIAL_USERNAME, input("playfab dev secret key: "))
-
-	elif sys.argv[1] == AUTH_AAD_TAG:
-
-		keyring.set_password("client_id", CREDENTIAL_USERNAME, input("aad client id: "))
-		keyring.set_password("client_secret", CREDENTIAL_USERNAME, input("aad client secret value (not id): "))
-		keyring.set_password("tenant_id", CREDENTIAL_USERNAME, input("aad tenant id: "))
-
-	elif sys.argv[1] == AUTH_ROBLOX_TAG:
-
-		keyring.set_password("cookie", CREDENTIAL_USERNAME, input("roblox security cookie: "))
-
-	elif sys.argv[1] == DOWNLOAD_TAG:
+def add_download_arguments(parser: ArgumentParser):
+	parser.add_argument("path", help="the file the events are written to")
+	parser.add_argument("start", help="only users that joined after this date are downloaded, e.g. \"2023-06-25 18:37:11.0000\"")
+	parser.add_argument("duration", type=int, help="the number of days after the start date to collect users from")
+	parser.add_argument("limit", type=int, help="the maximum number of users to download")
+	parser.add_argument(RAW_TAG, action="store_true", help="skip decoding")
+	parser.add_argument(STREAM_TAG, action="store_true", help="decode and append the events page by page")
+	parser.add_argument(WORKERS_TAG, type=int, default=None, help="the number of decoding processes, one per cpu core by default")
+	parser.add_argument(FORMAT_TAG, default="json", choices=config.OUTPUT_FORMATS, help="json, ndjson, parquet or arrow")
+	parser.add_argument(RESUME_TAG, action="store_true", help="continue an interrupted download of the same file")
+	parser.add_argument(SINCE_LAST_TAG, action="store_true", help="only download events newer than the last download")
+	parser.add_argument(CONCURRENCY_TAG, type=int, default=None, help="the most pages requested at once, 4 by default")
+	parser.add_argument(ENDPOINT_TAG, default=None, help="query a local server such as midas mock-server instead of playfab, no credentials needed")
+	parser.add_argument(NO_CACHE_TAG, action="store_true", help="don't keep the downloaded pages for midas decode")
+	parser.add_argument(SELECT_TAG, action="append", default=[], help="only download this tree path, e.g. Performance/Server, can be repeated")
+	parser.add_argument(EVENT_TAG, action="append", default=[], help="only download events with this name, can be repeated")
+
+def add_decode_arguments(parser: ArgumentParser):
+	parser.add_argument("path", nargs="?", default=None, help="the file the decoded events are written to")
+	parser.add_argument(SLICE_TAG, default=None, help="the start of a cached download's key, the latest finished download by default")
+	parser.add_argument(LIST_TAG, action="store_true", help="list the cached downloads instead of decoding one")
+	parser.add_argument(RAW_TAG, action="store_true", help="write the cached events without decoding them")
+	parser.add_argument(WORKERS_TAG, type=int, default=None, help="the number of decoding processes, one per cpu core by default")
+	parser.add_argument(FORMAT_TAG, default="json", choices=config.OUTPUT_FORMATS, help="json, ndjson, parquet or arrow")
+	parser.add_argument(SELECT_TAG, action="append", default=[], help="only write columns under this tree path for parquet and arrow, can be repeated")
+
+def add_build_arguments(parser: ArgumentParser):
+	parser.add_argument("title_id", nargs="?", default=None, help="stores the playfab title id before building")
+	parser.add_argument("dev_secret_key", nargs="?", default=None, help="stores the playfab dev secret key before building")
+	parser.add_argument(FORCE_TAG, action="store_true", help="rewrite every script, even unchanged ones")
+	parser.add_argument(SERIAL_TAG, action="store_true", help="build the scripts one after another")
+	parser.add_argument(PROFILE_TAG, default=None, help="a decoded json / ndjson download used to give the most sent new keys the shortest codes")
+	parser.add_argument(SIZES_TAG, action="store_true", help="print how large the server boot's encoding is as tables and packed")
+
+def add_encoding_report_arguments(parser: ArgumentParser):
+	parser.add_argument(SAMPLE_TAG, default=None, help="a decoded json / ndjson download to measure instead of a simulated snapshot")
+	parser.add_argument(TOP_TAG, type=int, default=10, help="the number of largest subtrees to list")
+
+def add_mock_server_arguments(parser: ArgumentParser):
+	parser.add_argument(PORT_TAG, type=int, default=8080, help="the local port to serve on")
+	parser.add_argument(USERS_TAG, type=int, default=1000, help="the number of synthetic users")
+	parser.add_argument(EVENTS_PER_USER_TAG, type=int, default=100, help="the average number of events per user")
+	parser.add_argument(DAYS_TAG, type=int, default=30, help="the number of days the users join across")
+	parser.add_argument(LATENCY_TAG, type=float, default=0.0, help="seconds to wait before answering each query")
+	parser.add_argument(MAX_ROWS_TAG, type=int, default=0, help="refuse queries returning more rows than this, like kusto's record limit")
+	parser.add_argument(MAX_CONCURRENT_TAG, type=int, default=0, help="throttle requests beyond this many at once")
+	parser.add_argument(SEED_TAG, type=int, default=0, help="changes which events are generated")
+
+def add_no_arguments(parser: ArgumentParser):
+	pass
+
+def run_init(args: Namespace):
+	config.init_file()
+
+def run_build(args: Namespace):
+	import keyring
+	import src.treecode as treecode
+	import src.build as build
+	import src.auth as auth
+
+	midas_config = config.get_midas_config()
+	pattern_frequencies = None
+	if args.profile != None:
+		pattern_frequencies = treecode.get_pattern_frequencies(args.profile)
+	treecode.set_tree_encoding(midas_config, pattern_frequencies)
+	if args.title_id != None:
+		assert args.dev_secret_key != None, "a dev secret key needs to be provided with the title id"
+		keyring.set_password("title_id", CREDENTIAL_USERNAME, args.title_id)
+		keyring.set_password("dev_secret_key", CREDENTIAL_USERNAME, args.dev_secret_key)
+		auth.clear_auth_cache()
+
+	build.main(midas_config, is_forced=args.force, is_concurrent=not args.serial)
+	if args.sizes:
+		build.print_encoding_sizes(treecode.get_tree_encoding())
+
+def run_auth_playfab(args: Namespace):
+	import keyring
+	import src.auth as auth
+	keyring.set_password("title_id", CREDENTIAL_USERNAME, input("playfab title id: "))
+	keyring.set_password("dev_secret_key", CREDENTIAL_USERNAME, input("playfab dev secret key: "))
+	auth.clear_auth_cache()
+
+def run_auth_aad(args: Namespace):
+	import keyring
+	import src.auth as auth
+	keyring.set_password("client_id", CREDENTIAL_USERNAME, input("aad client id: "))
+	keyring.set_password("client_secret", CREDENTIAL_USERNAME, input("aad client secret value (not id): "))
+	keyring.set_password("tenant_id", CREDENTIAL_USERNAME, input("aad tenant id: "))
+	auth.clear_auth_cache()
+
+def run_auth_roblox(args: Namespace):
+	import keyring
+	import src.auth as auth
+	keyring.set_password("cookie", CREDENTIAL_USERNAME, input("roblox security cookie: "))
+	auth.clear_auth_cache()
+
+def run_auth_all(args: Namespace):
+	import keyring
+	import src.auth as auth
+	keyring.set_password("title_id", CREDENTIAL_USERNAME, input("playfab title id: "))
+	keyring.set_password("dev_secret_key", CREDENTIAL_USERNAME, input("playfab dev secret key: "))
+	keyring.set_password("client_id", CREDENTIAL_USERNAME, input("aad client id: "))
+	keyring.set_password("client_secret", CREDENTIAL_USERNAME, input("aad client secret: "))
+	keyring.set_password("tenant_id", CREDENTIAL_USERNAME, input("aad tenant id: "))
+	keyring.set_password("cookie", CREDENTIAL_USERNAME, input("roblox security cookie: "))
+	auth.clear_auth_cache()
+
+def run_download(args: Namespace):
+	download(
+		out_path=args.path,
+		download_start_data=args.start,
+		download_window=args.duration,
+		user_limit=args.limit,
+		is_raw=args.raw,
+		is_stream=args.stream,
+		worker_count=args.workers,
+		output_format=args.format,
+		is_resume=args.resume,
+		is_since_last=args.since_last,
+		endpoint=args.endpoint,
+		concurrency=args.concurrency,
+		is_cached=not args.no_cache,
+		selectors=args.select,
+		event_names=args.event
+	)
 
-		download(
-			json_path=sys.argv[2], 
-			download_start_data=sys.argv[3], 
-			download_window=int(sys.argv[4]), 
-			user_limit=int(sys.argv[5]),
-			is_raw=(RAW_TAG in sys.argv)
+def run_decode(args: Namespace):
+	import src.treecode as treecode
+	import src.decode as decode
+	import src.pagecache as pagecache
+	import src.projection as projection
+
+	page_cache = pagecache.PageCache()
+	try:
+		if args.list:
+			pagecache.print_slices(page_cache)
+			return
+
+		assert args.path != None, "a path to write the decoded events to is needed"
+		slice_key = page_cache.get_slice_key(args.slice)
+
+		encoding_index = None
+		midas_config = None
+		if not args.raw:
+			encoding_index = treecode.get_encoding_history()
+			if args.format != "json" and args.format != "ndjson":
+				midas_config = config.get_midas_config()
+
+		print(f"decoding cached download {slice_key[:12]}")
+		pagecache.decode_slice(
+			page_cache,
+			slice_key,
+			args.path,
+			encoding_index,
+			output_format=args.format,
+			midas_config=midas_config,
+			worker_count=args.workers if args.workers != None else decode.DEFAULT_WORKER_COUNT,
+			paths=[projection.get_path(selector) for selector in args.select]
 		)
+	finally:
+		page_cache.close()
+
+def run_encoding_report(args: Namespace):
+	import src.report as report
+	report.main(config.get_midas_config(), args.sample, args.top)
+
+def run_mock_server(args: Namespace):
+	import src.treecode as treecode
+	import src.mock_playfab as mock_playfab
+
+	assert os.path.exists(treecode.TREE_ENCODING_PATH), f"{treecode.TREE_ENCODING_PATH} doesn't exist yet, run midas build first"
+	mock_playfab.main(
+		config.get_midas_config(),
+		treecode.get_tree_encoding(),
+		port=args.port,
+		user_count=args.users,
+		events_per_user=args.events_per_user,
+		join_window_in_days=args.days,
+		latency=args.latency,
+		max_rows=args.max_rows,
+		max_concurrent=args.max_concurrent,
+		seed=args.seed
+	)
 
-	elif sys.argv[1] == CLEAN_TAG:
-
-		midas_config = config.get_midas_config()
-		config.remove_config()
-
-		server_boot_build_path = midas_config["build"]["server_boot_script_path"]
-		if os.path.exists(server_boot_build_path):
-			os.remove(server_boot_build_path)
-
-		client_boot_build_path = midas_config["build"]["client_boot_script_path"]
-		if os.path.exists(client_boot_build_path):
-			os.remove(client_boot_build_path)
-
-		shared_tree_build_path = midas_config["build"]["shared_state_tree_path"]
-		if os.path.exists(shared_tree_build_path):
-			os.remove(shared_tree_build_path)
-
-		# module_build_path = midas_config["build"]["midas_py_module_out_path"]
-		# if os.path.exists(module_build_path):
-		# 	os.remove(module_build_path)
-
-	elif sys.argv[1] == AUTH_ALL_TAG:
-
-		keyring.set_password("title_id", CREDENTIAL_USERNAME, input("playfab title id: "))
-		keyring.set_password("dev_secret_key", CREDENTIAL_USERNAME, input("playfab dev secret key: "))
-		keyring.set_password("client_id", CREDENTIAL_USERNAME, input("aad client id: "))
-		keyring.set_password("client_secret", CREDENTIAL_USERNAME, input("aad client secret: "))
-		keyring.set_password("tenant_id", CREDENTIAL_USERNAME, input("aad tenant id: "))
-		keyring.set_password("cookie", CREDENTIAL_USERNAME, input("roblox security cookie: "))
-
-	else:
-
-		raise ValueError(f"{sys.argv[1]} does not match any known tags")
+def run_clean(args: Namespace):
+	import src.build as build
+	import src.auth as auth
+
+	midas_config = config.get_midas_config()
+	config.remove_config()
+
+	server_boot_build_path = midas_config["build"]["server_boot_script_path"]
+	if os.path.exists(server_boot_build_path):
+		os.remove(server_boot_build_path)
+
+	client_boot_build_path = midas_config["build"]["client_boot_script_path"]
+	if os.path.exists(client_boot_build_path):
+		os.remove(client_boot_build_path)
+
+	shared_tree_build_path = midas_config["build"]["shared_state_tree_path"]
+	if os.path.exists(shared_tree_build_path):
+		os.remove(shared_tree_build_path)
+
+	if os.path.exists(build.BUILD_MANIFEST_PATH):
+		os.remove(build.BUILD_MANIFEST_PATH)
+
+	auth.clear_auth_cache()
+
+	# module_build_path = midas_config["build"]["midas_py_module_out_path"]
+	# if os.path.exists(module_build_path):
+	# 	os.remove(module_build_path)
+
+class Command(TypedDict):
+	help: str
+	add_arguments: Callable[[ArgumentParser], None]
+	run: Callable[[Namespace], None]
+
+# each command declares its own options, and its run function imports whatever it needs when called
+COMMANDS: dict[str, Command] = {
+	INIT_TAG: {"help": "create the midas.yaml config", "add_arguments": add_no_arguments, "run": run_init},
+	BUILD_LUAU_TAG: {"help": "build the roblox scripts", "add_arguments": add_build_arguments, "run": run_build},
+	AUTH_PLAYFAB_TAG: {"help": "store the playfab credentials", "add_arguments": add_no_arguments, "run": run_auth_playfab},
+	AUTH_AAD_TAG: {"help": "store the aad app credentials", "add_arguments": add_no_arguments, "run": run_auth_aad},
+	AUTH_ROBLOX_TAG: {"help": "store the roblox security cookie", "add_arguments": add_no_arguments, "run": run_auth_roblox},
+	AUTH_ALL_TAG: {"help": "store every credential", "add_arguments": add_no_arguments, "run": run_auth_all},
+	DOWNLOAD_TAG: {"help": "download and decode events", "add_arguments": add_download_arguments, "run": run_download},
+	DECODE_TAG: {"help": "decode a cached download again without downloading it", "add_arguments": add_decode_arguments, "run": run_decode},
+	ENCODING_REPORT_TAG: {"help": "estimate the encoded size of each event and rank the largest subtrees", "add_arguments": add_encoding_report_arguments, "run": run_encoding_report},
+	MOCK_SERVER_TAG: {"help": "serve synthetic events from a local stand-in for playfab", "add_arguments": add_mock_server_arguments, "run": run_mock_server},
+	CLEAN_TAG: {"help": "remove midas from the project", "add_arguments": add_no_arguments, "run": run_clean},
+}
+
+def get_parser() -> ArgumentParser:
+	# abbreviations are off so the single dash flags can't be mistaken for one another
+	parser = ArgumentParser(prog="midas", allow_abbrev=False)
+	subparsers = parser.add_subparsers(dest="command", metavar="command", required=True)
+	for name, command in COMMANDS.items():
+		command_parser = subparsers.add_parser(name, help=command["help"], allow_abbrev=False)
+		command["add_arguments"](command_parser)
+
+	return parser
+
+def main(argv: list[str] | None=None):
+	args = get_parser().parse_args(argv)
+	COMMANDS[args.command]["run"](args)
 
 # prevent from running twice
 if __name__ == '__main__':
 	multiprocessing.freeze_support()
-	main()		
+	main()
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import hashlib
+from typing import TypedDict
+from azure.kusto.data import KustoClient, KustoConnectionStringBuilder
+from midas.playfab import PlayFabClient, CLUSTER
+from src.projection import PlayFabQueryClient
+import src.config as config
+from src.config import AuthConfig, CREDENTIAL_USERNAME
+
+AUTH_CACHE_VERSION = 1
+CACHE_KEY_NAME = "cache_key"
+
+# credentials are read from the keyring again after this long, so edits made outside of midas are picked up
+CREDENTIAL_CACHE_SECONDS = 60*60
+
+# a token is only reused while it has at least this long left, so a download doesn't outlive it
+TOKEN_EXPIRY_MARGIN_SECONDS = 5*60
+
+AAD_AUTHORITY = "https://login.microsoftonline.com/"
+AAD_RESOURCE = "https://help.kusto.windows.net"
+
+class CachedToken(TypedDict):
+	access_token: str
+	expires_at: float
+
+class AuthCache(TypedDict):
+	version: int
+	auth_config: AuthConfig | None
+	auth_expires_at: float
+	tokens: dict[str, CachedToken]
+
+def get_auth_cache_path() -> str:
+	file_name = hashlib.sha1(CREDENTIAL_USERNAME.encode("utf-8")).hexdigest()[:16] + ".bin"
+	return os.path.join(config.get_cache_dir("auth"), file_name)
+
+def get_empty_auth_cache() -> AuthCache:
+	return {"version": AUTH_CACHE_VERSION, "auth_config": None, "auth_expires_at": 0, "tokens": {}}
+
+# the key lives in the keyring, so the cache file is useless to anyone who can't already read the credentials
+def get_cache_fernet():
+	import keyring
+	from cryptography.fernet import Fernet
+
+	cache_key = keyring.get_password(CACHE_KEY_NAME, CREDENTIAL_USERNAME)
+	if not cache_key:
+		cache_key = Fernet.generate_key().decode("utf-8")
+		keyring.set_password(CACHE_KEY_NAME, CREDENTIAL_USERNAME, cache_key)
+
+	return Fernet(cache_key.encode("utf-8"))
+
+def read_auth_cache(fernet) -> AuthCache:
+	from cryptography.fernet import InvalidToken
+
+	cache_path = get_auth_cache_path()
+	if not os.path.exists(cache_path):
+		return get_empty_auth_cache()
+
+	try:
+		cache_file = open(cache_path, "rb")
+		auth_cache: AuthCache = json.loads(fernet.decrypt(cache_file.read()))
+		cache_file.close()
+	except (OSError, ValueError, InvalidToken):
+		return get_empty_auth_cache()
+
+	if auth_cache.get("version") != AUTH_CACHE_VERSION:
+		return get_empty_auth_cache()
+	return auth_cache
+
+# replaced rather than rewritten, so parallel runs never read a half written cache
+def write_auth_cache(fernet, auth_cache: AuthCache):
+	cache_path = get_auth_cache_path()
+	tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+
+	cache_file = open(tmp_path, "wb")
+	cache_file.write(fernet.encrypt(json.dumps(auth_cache).encode("utf-8")))
+	cache_file.close()
+	if os.name != "nt":
+		os.chmod(tmp_path, 0o600)
+	os.replace(tmp_path, cache_path)
+
+def clear_auth_cache():
+	cache_path = get_auth_cache_path()
+	if os.path.exists(cache_path):
+		os.remove(cache_path)
+
+def get_cached_auth_config() -> AuthConfig:
+	fernet = get_cache_fernet()
+	auth_cache = read_auth_cache(fernet)
+
+	auth_config = auth_cache["auth_config"]
+	if auth_config != None and auth_cache["auth_expires_at"] > time.time():
+		return auth_config
+
+	auth_config = config.get_auth_config()
+	auth_cache["auth_config"] = auth_config
+	auth_cache["auth_expires_at"] = time.time() + CREDENTIAL_CACHE_SECONDS
+	write_auth_cache(fernet, auth_cache)
+	return auth_config
+
+def get_token_key(tenant_id: str, client_id: str) -> str:
+	return hashlib.sha1(f"{tenant_id}/{client_id}/{AAD_RESOURCE}".encode("utf-8")).hexdigest()
+
+def acquire_token(tenant_id: str, client_id: str, client_secret: str) -> CachedToken:
+	from adal import AuthenticationContext
+
+	context = AuthenticationContext(AAD_AUTHORITY + tenant_id)
+	token_response = context.acquire_token_with_client_credentials(AAD_RESOURCE, client_id, client_secret)
+	return {
+		"access_token": token_response["accessToken"],
+		"expires_at": time.time() + float(token_response["expiresIn"]),
+	}
+
+def get_cached_token(tenant_id: str, client_id: str, client_secret: str) -> str:
+	fernet = get_cache_fernet()
+	auth_cache = read_auth_cache(fernet)
+
+	token_key = get_token_key(tenant_id, client_id)
+	now = time.time()
+	cached_token = auth_cache["tokens"].get(token_key)
+	if cached_token != None and cached_token["expires_at"] - TOKEN_EXPIRY_MARGIN_SECONDS > now:
+		return cached_token["access_token"]
+
+	cached_token = acquire_token(tenant_id, client_id, client_secret)
+
+	# another run may have refreshed the cache meanwhile, so only this token is swapped into the latest copy
+	auth_cache = read_auth_cache(fernet)
+	auth_cache["tokens"] = {key: token for key, token in auth_cache["tokens"].items() if token["expires_at"] > now}
+	auth_cache["tokens"][token_key] = cached_token
+	write_auth_cache(fernet, auth_cache)
+	return cached_token["access_token"]
+
+# the same client as PlayFabClient, except the aad token comes from the cache while it's still valid
+class CachedPlayFabClient(PlayFabQueryClient):
+	def __init__(self, client_id: str, client_secret: str, tenant_id: str, title_id: str):
+		self.title_id = title_id
+		self.client_id = client_id
+		self.client_secret = client_secret
+		self.tenant_id = tenant_id
+
+		token = get_cached_token(tenant_id, client_id, client_secret)
+		kcsb = KustoConnectionStringBuilder.with_aad_application_token_authentication(CLUSTER, token)
+		self.client = KustoClient(kcsb)
+		self.client._query_endpoint = CLUSTER + "/v1/rest/query"
+
+def get_playfab_client(auth_config: AuthConfig) -> PlayFabClient:
+	return CachedPlayFabClient(
+		client_id = auth_config["aad"]["client_id"],
+		client_secret = auth_config["aad"]["client_secret"],
+		tenant_id = auth_config["aad"]["tenant_id"],
+		title_id = auth_config["playfab"]["title_id"]
+	)
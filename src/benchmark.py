@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import statistics
+from datetime import datetime, timezone
+from typing import TypedDict, Callable, Any
+from pandas import DataFrame
+import src.config as config
+import src.treecode as treecode
+import src.decode as decode
+import src.export as export
+import src.build as build
+import src.synthetic as synthetic
+
+BENCHMARK_RESULTS_PATH = "midas-benchmark.json"
+TREE_LEAF_COUNTS = [100, 1000, 10000]
+CODE_COUNT = 10000
+BUILD_LEAF_COUNT = 1000
+DECODE_USER_COUNT = 200
+DECODE_EVENTS_PER_USER = 100
+BINARY_KEY_COUNT = 500
+DEFAULT_REPEAT = 5
+
+# a result counts as a regression once its best time is this many times slower than the baseline's
+REGRESSION_THRESHOLD = 1.25
+
+class BenchmarkResult(TypedDict):
+	name: str
+	repeat: int
+	items: int
+	best_seconds: float
+	median_seconds: float
+	items_per_second: float
+
+class BenchmarkReport(TypedDict):
+	created_at: str
+	python: str
+	platform: str
+	cpu_count: int
+	results: list[BenchmarkResult]
+
+def measure(name: str, function: Callable[[], Any], items=1, repeat=DEFAULT_REPEAT, setup: Callable[[], Any] | None=None) -> BenchmarkResult:
+	durations = []
+	for _ in range(repeat):
+		if setup != None:
+			setup()
+		start_tick = time.perf_counter()
+		function()
+		durations.append(time.perf_counter() - start_tick)
+
+	best_seconds = min(durations)
+	result: BenchmarkResult = {
+		"name": name,
+		"repeat": repeat,
+		"items": items,
+		"best_seconds": best_seconds,
+		"median_seconds": statistics.median(durations),
+		"items_per_second": items / best_seconds if best_seconds > 0 else 0,
+	}
+	print(f"{name}: {round(best_seconds*1000, 2)}ms best of {repeat}, {round(result['items_per_second'])} items/s")
+	return result
+
+def remove_tree_encoding():
+	for path in [treecode.TREE_ENCODING_PATH, treecode.TREE_ENCODING_INDEX_PATH]:
+		if os.path.exists(path):
+			os.remove(path)
+
+def benchmark_codes(repeat: int) -> list[BenchmarkResult]:
+	def get_codes():
+		for index in range(1, CODE_COUNT+1):
+			treecode.get_code(index, treecode.ENCODING_MARKER)
+
+	return [measure("get_code", get_codes, CODE_COUNT, repeat)]
+
+def benchmark_tree_encoding(repeat: int) -> list[BenchmarkResult]:
+	results = []
+	for leaf_count in TREE_LEAF_COUNTS:
+		midas_config = synthetic.get_synthetic_config(leaf_count)
+		results.append(measure(
+			f"set_tree_encoding/{leaf_count}/new",
+			lambda: treecode.set_tree_encoding(midas_config),
+			leaf_count,
+			repeat,
+			setup=remove_tree_encoding
+		))
+
+		# re-encoding an unchanged tree is what every build after the first does
+		results.append(measure(
+			f"set_tree_encoding/{leaf_count}/unchanged",
+			lambda: treecode.set_tree_encoding(midas_config),
+			leaf_count,
+			repeat
+		))
+
+		encoding_tree = treecode.get_tree_encoding()
+		results.append(measure(
+			f"compile_encoding_index/{leaf_count}",
+			lambda: treecode.compile_encoding_index(encoding_tree, ""),
+			leaf_count,
+			repeat
+		))
+
+	return results
+
+def benchmark_builders(repeat: int) -> list[BenchmarkResult]:
+	midas_config = synthetic.get_synthetic_config(BUILD_LEAF_COUNT)
+	treecode.set_tree_encoding(midas_config)
+
+	# the first call extracts and links the packages, which isn't what's being measured
+	build.build_client_boot(midas_config, {})
+
+	results = []
+	for builder in [build.build_shared_state_tree, build.build_shared_event_tree, build.build_client_boot, build.build_server_boot]:
+		# an empty manifest makes every call write its script, like a forced build
+		results.append(measure(f"{builder.__name__}/{BUILD_LEAF_COUNT}", lambda: builder(midas_config, {}), 1, repeat))
+
+	compact_config = {**midas_config, "build": {**midas_config["build"], "compact_encoding": True}}
+	results.append(measure(f"build_server_boot/{BUILD_LEAF_COUNT}/compact", lambda: build.build_server_boot(compact_config, {}), 1, repeat))
+
+	return results
+
+def benchmark_decoding(repeat: int) -> list[BenchmarkResult]:
+	midas_config = synthetic.get_synthetic_config(0)
+	treecode.set_tree_encoding(midas_config)
+	encoding_index = treecode.get_encoding_index()
+
+	user_ids = synthetic.get_synthetic_user_ids(DECODE_USER_COUNT)
+	raw_df = DataFrame(synthetic.get_synthetic_events(midas_config, treecode.get_tree_encoding(), user_ids, DECODE_EVENTS_PER_USER))
+	row_count = len(raw_df.index)
+
+	column_types = export.get_column_types(midas_config)
+	results = [
+		measure("decode_raw_df/1", lambda: decode.decode_raw_df(raw_df, encoding_index, 1), row_count, repeat),
+		measure("decode_typed_df/1", lambda: decode.decode_typed_df(raw_df, encoding_index, column_types, 1), row_count, repeat),
+	]
+
+	# as wide as a game with hundreds of badges
+	packed_values = [treecode.ENCODING_MARKER + "".join(["1" if (row_index + key_index) % 3 == 0 else "0" for key_index in range(BINARY_KEY_COUNT)]) for row_index in range(row_count)]
+	results.append(measure(
+		f"unpack_binary_strings/{BINARY_KEY_COUNT}",
+		lambda: decode.unpack_binary_strings(packed_values, BINARY_KEY_COUNT, treecode.ENCODING_MARKER),
+		row_count,
+		repeat
+	))
+
+	if decode.DEFAULT_WORKER_COUNT > 1:
+		with decode.create_pool(encoding_index, decode.DEFAULT_WORKER_COUNT) as pool:
+			results.append(measure(
+				f"decode_raw_df/{decode.DEFAULT_WORKER_COUNT}",
+				lambda: decode.decode_raw_df(raw_df, encoding_index, decode.DEFAULT_WORKER_COUNT, pool),
+				row_count,
+				repeat
+			))
+
+	return results
+
+def get_regressions(report: BenchmarkReport, baseline: BenchmarkReport, threshold=REGRESSION_THRESHOLD) -> list[str]:
+	baseline_results = {result["name"]: result for result in baseline["results"]}
+
+	regressions = []
+	for result in report["results"]:
+		if not result["name"] in baseline_results:
+			continue
+		baseline_seconds = baseline_results[result["name"]]["best_seconds"]
+		if baseline_seconds > 0 and result["best_seconds"] > baseline_seconds*threshold:
+			regressions.append(f"{result['name']} took {round(result['best_seconds']*1000, 2)}ms, the baseline took {round(baseline_seconds*1000, 2)}ms")
+
+	return regressions
+
+def main(out_path=BENCHMARK_RESULTS_PATH, baseline_path: str | None=None, repeat=DEFAULT_REPEAT, threshold=REGRESSION_THRESHOLD) -> list[str]:
+	out_path = os.path.abspath(out_path)
+	if baseline_path != None:
+		baseline_path = os.path.abspath(baseline_path)
+
+	# every benchmark writes its configs, caches and scripts into a throwaway project folder
+	original_path = os.getcwd()
+	project_path = tempfile.mkdtemp(prefix="midas-benchmark-")
+	os.chdir(project_path)
+
+	try:
+		results: list[BenchmarkResult] = []
+		results += benchmark_codes(repeat)
+		results += benchmark_tree_encoding(repeat)
+		results += benchmark_builders(repeat)
+		results += benchmark_decoding(repeat)
+	finally:
+		os.chdir(original_path)
+		shutil.rmtree(project_path, ignore_errors=True)
+
+	report: BenchmarkReport = {
+		"created_at": datetime.now(timezone.utc).isoformat(),
+		"python": sys.version.split(" ")[0],
+		"platform": platform.platform(),
+		"cpu_count": os.cpu_count() or 1,
+		"results": results,
+	}
+
+	out_file = open(out_path, "w")
+	out_file.write(json.dumps(report, indent=4))
+	out_file.close()
+	print(f"\nwrote results to {out_path}")
+
+	if baseline_path == None:
+		return []
+
+	regressions = get_regressions(report, json.loads(open(baseline_path, "r").read()), threshold)
+	for regression in regressions:
+		print(f"regression: {regression}")
+	return regressions
@@ -1,53 +1,173 @@
 import src.config as config
 import src.treecode as treecode
+from src.config import MidasConfig
 import luau
 import dpath
 import toml
 import sys
 import os
+import re
+import json
+import mmap
+import shutil
+import hashlib
+import tempfile
+import functools
+import threading
+import time
+from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor
 from luau import import_type, indent_block
 from luau.convert import from_any, mark_as_literal
 from luau.roblox import write_script, get_package_require, get_module_require
+from luau.roblox.rojo import build_sourcemap
 from luau.path import remove_all_path_variants, get_if_module_script, get_if_using_lua_or_luau_ext
-from typing import TypedDict, Literal, Union, Any
+from typing import TypedDict, Literal, Union, Any, Callable
 ENCODING_MARKER = config.ENCODING_MARKER
 GENERATED_HEADER_WARNING_COMMENT = "-- this script was generated by nightcycle/midas-clt, do not manually edit"
+BUILD_MANIFEST_PATH = "midas.build"
+
+# separators in the packed encoding, control characters so no key, option or code can contain them
+PACKED_VALUE_END = "\x01"
+PACKED_KEY_END = "\x02"
+PACKED_TABLE_START = "\x03"
+PACKED_TABLE_END = "\x04"
+PACKED_ENCODING_NAME = "PACKED_ENCODING"
+
+# a short escape like \1 would swallow a digit after it, so those get all three digits
+LUAU_ESCAPE_PATTERN = re.compile(r"[\x01-\x04](\d?)")
 
 def get_package_zip_path() -> str:
 	base_path = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
 
-	return os.path.join(base_path, "data\\Packages.zip")
+	return os.path.join(base_path, "data", "Packages.zip")
+
+@functools.lru_cache(maxsize=None)
+def get_package_zip_hash() -> str:
+	with open(get_package_zip_path(), "rb") as zip_file:
+		with mmap.mmap(zip_file.fileno(), 0, access=mmap.ACCESS_READ) as zip_buffer:
+			return hashlib.sha256(zip_buffer).hexdigest()
+
+# the builders run on separate threads, so only let one of them extract
+_extract_lock = threading.Lock()
+
+def get_extracted_packages_path() -> str:
+	extracted_path = os.path.join(config.get_cache_dir("packages"), get_package_zip_hash()[0:16])
+
+	with _extract_lock:
+		if os.path.exists(extracted_path):
+			return extracted_path
+
+		# extract beside the final path and swap it in, so an interrupted or concurrent run never sees half a tree
+		temp_path = tempfile.mkdtemp(dir=os.path.dirname(extracted_path))
+		try:
+			with ZipFile(get_package_zip_path(), "r") as zip_ref:
+				zip_ref.extractall(temp_path)
+			os.replace(temp_path, extracted_path)
+		except OSError:
+			if not os.path.exists(extracted_path):
+				raise
+		finally:
+			shutil.rmtree(temp_path, ignore_errors=True)
+
+	return extracted_path
+
+# copied rather than hard linked, so editing a project's Packages can't change the cache every other project copies from
+def copy_tree(source_path: str, target_path: str):
+	for dir_path, dir_names, file_names in os.walk(source_path):
+		relative_path = os.path.relpath(dir_path, source_path)
+		target_dir_path = os.path.normpath(os.path.join(target_path, relative_path))
+		os.makedirs(target_dir_path, exist_ok=True)
+		for file_name in file_names:
+			source_file_path = os.path.join(dir_path, file_name)
+			shutil.copy2(source_file_path, os.path.join(target_dir_path, file_name))
+
+class BuildRecord(TypedDict):
+	input_hash: str
+	output_hash: str
+
+def get_file_hash(path: str) -> str:
+	with open(path, "rb") as file:
+		return hashlib.sha256(file.read()).hexdigest()
+
+# covers the script and the packages copied beside it, so editing either gets it rebuilt
+def get_tree_hash(dir_path: str) -> str:
+	tree_hash = hashlib.sha256()
+	for current_path, dir_names, file_names in os.walk(dir_path):
+		dir_names.sort()
+		for file_name in sorted(file_names):
+			file_path = os.path.join(current_path, file_name)
+			tree_hash.update(os.path.relpath(file_path, dir_path).replace(os.sep, "/").encode("utf-8"))
+			tree_hash.update(get_file_hash(file_path).encode("utf-8"))
+	return tree_hash.hexdigest()
+
+# mirrors where luau's write_script puts the script when it is written as a directory
+def get_written_script_path(build_path: str) -> str:
+	dir_name, file_name = os.path.split(build_path)
+	full_ext = ".".join(build_path.split(".")[1:])
+	final_dir_path = (dir_name+"/"+file_name).replace(full_ext, "")
+	return final_dir_path+"/init."+full_ext
+
+def read_build_manifest() -> dict[str, BuildRecord]:
+	if not os.path.exists(BUILD_MANIFEST_PATH):
+		return {}
+	return json.loads(open(BUILD_MANIFEST_PATH, "r").read())
+
+def write_build_manifest(manifest: dict[str, BuildRecord]):
+	is_new = not os.path.exists(BUILD_MANIFEST_PATH)
+	manifest_file = open(BUILD_MANIFEST_PATH, "w")
+	manifest_file.write(json.dumps(manifest, indent=4, sort_keys=True))
+	manifest_file.close()
+
+	if is_new and os.path.exists(".gitignore"):
+		config.add_to_git_ignore(BUILD_MANIFEST_PATH)
+
+def write_script_if_changed(build_path: str, content: str, manifest: dict[str, BuildRecord], domain="") -> bool:
+	input_hash = hashlib.sha256()
+	input_hash.update(build_path.encode("utf-8"))
+	input_hash.update(content.encode("utf-8"))
+	input_hash.update(get_package_zip_hash().encode("utf-8"))
+
+	script_path = get_written_script_path(build_path)
+
+	# the output hash catches scripts or packages that were edited or deleted since they were written
+	if build_path in manifest and os.path.exists(script_path):
+		record = manifest[build_path]
+		if record["input_hash"] == input_hash.hexdigest() and record["output_hash"] == get_tree_hash(os.path.dirname(script_path)):
+			return False
+
+	remove_all_path_variants(build_path, domain)
+
+	# write_script only creates the parent folder when it's missing, which races when two scripts share a folder
+	os.makedirs(os.path.dirname(build_path), exist_ok=True)
+	write_script(build_path, content, write_as_directory=True, skip_source_map=True)
+	copy_tree(get_extracted_packages_path(), os.path.dirname(script_path))
+
+	manifest[build_path] = {
+		"input_hash": input_hash.hexdigest(),
+		"output_hash": get_tree_hash(os.path.dirname(script_path)),
+	}
+	return True
+
+def get_tree_types(midas_config: MidasConfig) -> tuple[dict[str, str], dict[str, str]]:
+	tree_paths: dict[str, str] = {}
+	literals: dict[str, str] = {}
 
-def build_shared_state_tree():
+	for path, leaf in config.get_tree_index(midas_config)["leaves"].items():
+		if leaf["options"] != None:
+			literal_type_name = path.replace("/", "") + "Type"
+			literals[literal_type_name] = " | ".join([from_any(v) for v in leaf["options"] if v != "nil"])
+			tree_paths[path] = literal_type_name
+		else:
+			tree_paths[path] = leaf["value"]
+
+	return tree_paths, literals
 
-	midas_config = config.get_midas_config()
+def build_shared_state_tree(midas_config: MidasConfig, manifest: dict[str, BuildRecord]) -> bool:
 	build_path = midas_config["build"]["shared_state_tree_path"]
 
-	remove_all_path_variants(build_path)
-
-	tree_paths = {}
-	literals = {}
-
-	for path, value in dpath.search(midas_config["tree"], '**', yielded=True):
-		path_keys = path.split("/")
-		has_num_key = False
-		for key in path_keys:
-			try:
-				int(key)
-				has_num_key = True
-			except:
-				has_num_key = False
-		if not has_num_key:
-			if type(value) == list:
-				literal_type_name = path.replace("/", "") + "Type"
-				literals[literal_type_name] = ""
-				for v in value:
-					if v != "nil":
-						literals[literal_type_name] += from_any(v) + " | "
-				literals[literal_type_name] = literals[literal_type_name][0:(len(literals[literal_type_name])-3)]	
-				tree_paths[path] = literal_type_name
-			elif not isinstance(value, dict):
-				tree_paths[path] = value
+
+	tree_paths, literals = get_tree_types(midas_config)
 
 	contents = [
 		"--!strict",
@@ -104,39 +224,14 @@ def build_shared_state_tree():
 		f"\nreturn {from_any(tree_data, indent_count=0, add_comma_at_end=False, multi_line=True, skip_initial_indent=True)}"
 	]
 
-	write_script(build_path, "\n".join(contents), packages_dir_zip_file_path=get_package_zip_path())
-
+	return write_script_if_changed(build_path, "\n".join(contents), manifest)
 
-def build_shared_event_tree():
 
-	midas_config = config.get_midas_config()
+def build_shared_event_tree(midas_config: MidasConfig, manifest: dict[str, BuildRecord]) -> bool:
 	build_path = midas_config["build"]["shared_event_tree_path"]
 
-	remove_all_path_variants(build_path)
-
-	tree_paths = {}
-	literals = {}
-
-	for path, value in dpath.search(midas_config["tree"], '**', yielded=True):
-		path_keys = path.split("/")
-		has_num_key = False
-		for key in path_keys:
-			try:
-				int(key)
-				has_num_key = True
-			except:
-				has_num_key = False
-		if not has_num_key:
-			if type(value) == list:
-				literal_type_name = path.replace("/", "") + "Type"
-				literals[literal_type_name] = ""
-				for v in value:
-					if v != "nil":
-						literals[literal_type_name] += from_any(v) + " | "
-				literals[literal_type_name] = literals[literal_type_name][0:(len(literals[literal_type_name])-3)]	
-				tree_paths[path] = literal_type_name
-			elif not isinstance(value, dict):
-				tree_paths[path] = value
+
+	tree_paths, literals = get_tree_types(midas_config)
 
 	contents = [
 		"--!strict",
@@ -173,14 +268,12 @@ def build_shared_event_tree():
 		f"\nreturn {from_any(tree_data, indent_count=0, add_comma_at_end=False, multi_line=True, skip_initial_indent=True)}"
 	]
 
-	write_script(build_path, "\n".join(contents), packages_dir_zip_file_path=get_package_zip_path())
+	return write_script_if_changed(build_path, "\n".join(contents), manifest)
 
 
-def build_client_boot():
-	midas_config = config.get_midas_config()
+def build_client_boot(midas_config: MidasConfig, manifest: dict[str, BuildRecord]) -> bool:
 	build_path = midas_config["build"]["client_boot_script_path"]
 
-	remove_all_path_variants(build_path, "client")
 	contents = [
 		"--!strict",
 		GENERATED_HEADER_WARNING_COMMENT,	
@@ -219,15 +312,101 @@ def build_client_boot():
 			f"init()"
 		]
 
-	write_script(build_path, "\n".join(contents), packages_dir_zip_file_path=get_package_zip_path())
+	return write_script_if_changed(build_path, "\n".join(contents), manifest, "client")
+
+def get_encoding_table(encoding_config: treecode.EncodingTree) -> dict[str, Any]:
+	return {
+		"Marker": ENCODING_MARKER,
+		"Dictionary": {
+			"Properties": encoding_config["dictionary"]["properties"],
+			"Values": encoding_config["dictionary"]["values"]
+		},
+		"Arrays": encoding_config["arrays"]
+	}
 
-def build_server_boot():
+def pack_table(value: dict | list, parts: list[str]):
+	items = value.items() if type(value) == dict else [(None, item) for item in value]
+	for key, item in items:
+		assert key == None or not any(separator in key for separator in [PACKED_VALUE_END, PACKED_KEY_END, PACKED_TABLE_START, PACKED_TABLE_END]), f"{repr(key)} can't be packed"
+		if type(item) == dict or type(item) == list:
+			parts.append(key + PACKED_TABLE_START)
+			pack_table(item, parts)
+			parts.append(PACKED_TABLE_END)
+		elif key == None:
+			parts.append(item + PACKED_VALUE_END)
+		else:
+			parts.append(key + PACKED_KEY_END + item + PACKED_VALUE_END)
+
+# the same tables flattened into one string, which unpackEncoding in the server boot script turns back into them
+def get_packed_encoding(encoding_table: dict[str, Any]) -> str:
+	parts: list[str] = []
+	pack_table(encoding_table, parts)
+	return "".join(parts)
+
+def get_separator_escape(match: re.Match) -> str:
+	separator_code = ord(match.group(0)[0])
+	if match.group(1) == "":
+		return f"\\{separator_code}"
+	return f"\\{separator_code:03d}" + match.group(1)
+
+def get_luau_string(text: str) -> str:
+	text = text.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n").replace("\r", "\\r")
+	return "\"" + LUAU_ESCAPE_PATTERN.sub(get_separator_escape, text) + "\""
+
+def get_unpack_encoding_block(encoding_table: dict[str, Any]) -> list[str]:
+	return [
+		"\n-- the encoding is packed into one string, which loads much faster than the tables it unpacks into",
+		f"local {PACKED_ENCODING_NAME} = {get_luau_string(get_packed_encoding(encoding_table))}",
+		"\nfunction unpackEncoding(packed: string): {[string]: any}",
+		] + indent_block([
+			"local root: {[any]: any} = {}",
+			"local parents: {{[any]: any}} = {}",
+			"local current: {[any]: any} = root",
+			"local key: string? = nil",
+			"for text: string, separator: string in string.gmatch(packed, \"([^\\1-\\4]*)([\\1-\\4])\") do",
+			] + indent_block([
+				"if separator == \"\\1\" then",
+				"\tif key then",
+				"\t\tcurrent[key] = text",
+				"\t\tkey = nil",
+				"\telse",
+				"\t\ttable.insert(current, text)",
+				"\tend",
+				"elseif separator == \"\\2\" then",
+				"\tkey = text",
+				"elseif separator == \"\\3\" then",
+				"\tlocal child = {}",
+				"\tcurrent[text] = child",
+				"\ttable.insert(parents, current)",
+				"\tcurrent = child",
+				"else",
+				"\tcurrent = table.remove(parents) :: any",
+				"end",
+			]) + [
+			"end",
+			"return root",
+		]) + [
+		"end",
+	]
+
+# how many characters the encoding takes up in the server boot script, written as tables and packed
+def get_encoding_sizes(encoding_config: treecode.EncodingTree) -> tuple[int, int]:
+	encoding_table = get_encoding_table(encoding_config)
+	table_text = from_any(encoding_table, indent_count=2, skip_initial_indent=True, add_comma_at_end=False, multi_line=True)
+	packed_text = "\n".join(get_unpack_encoding_block(encoding_table)) + f"unpackEncoding({PACKED_ENCODING_NAME})"
+	return len(table_text), len(packed_text)
+
+def print_encoding_sizes(encoding_config: treecode.EncodingTree):
+	table_size, packed_size = get_encoding_sizes(encoding_config)
+	print(f"server boot encoding: {table_size} characters as tables, {packed_size} packed, {round(100*packed_size/table_size)}% of the size")
+
+def build_server_boot(midas_config: MidasConfig, manifest: dict[str, BuildRecord]) -> bool:
 	auth_config = config.get_auth_config()
-	midas_config = config.get_midas_config()
 	encoding_config = treecode.get_tree_encoding()
+	encoding_table = get_encoding_table(encoding_config)
+	is_compact = midas_config["build"].get("compact_encoding") == True
 
 	build_path = midas_config["build"]["server_boot_script_path"]
-	remove_all_path_variants(build_path, "server")
 	
 	title_id = auth_config["playfab"]["title_id"]
 	dev_secret_key = auth_config["playfab"]["dev_secret_key"]
@@ -238,14 +417,7 @@ def build_server_boot():
 			"Minor": midas_config["version"]["minor"],
 			"Patch": midas_config["version"]["patch"],
 		},
-		"Encoding": {
-			"Marker": ENCODING_MARKER,
-			"Dictionary": {
-				"Properties": encoding_config["dictionary"]["properties"],
-				"Values": encoding_config["dictionary"]["values"]
-			},
-			"Arrays": encoding_config["arrays"]
-		},
+		"Encoding": mark_as_literal(f"unpackEncoding({PACKED_ENCODING_NAME})") if is_compact else encoding_table,
 		"SendDeltaState": False,
 		"PrintLog": False,
 		"SendDataToPlayFab": True,
@@ -263,6 +435,8 @@ def build_server_boot():
 		"local Midas = " + get_module_require(midas_config["build"]["midas_package_rbx_path"]),
 		"\ntype Maid = Maid.Maid",
 	]
+	if is_compact:
+		contents += get_unpack_encoding_block(encoding_table)
 
 	config_text = f"-- configure package \nMidas:Configure({from_any(config_table, indent_count=1, skip_initial_indent=True, add_comma_at_end=False, multi_line=True)})"
 	init_text = f"-- initialize playfab http request variables \nMidas.init(\"{title_id}\", \"{dev_secret_key}\")"
@@ -298,10 +472,41 @@ def build_server_boot():
 			f"init(maid)"
 		]
 
-	write_script(build_path, "\n".join(contents), packages_dir_zip_file_path=get_package_zip_path())
+	return write_script_if_changed(build_path, "\n".join(contents), manifest, "server")
+
+def run_builder(builder: Callable[[MidasConfig, dict[str, BuildRecord]], bool], midas_config: MidasConfig, manifest: dict[str, BuildRecord]) -> tuple[bool, float]:
+	start_tick = time.perf_counter()
+	is_written = builder(midas_config, manifest)
+	return is_written, time.perf_counter() - start_tick
+
+def main(midas_config: MidasConfig | None = None, is_forced=False, is_concurrent=True):
+	if midas_config == None:
+		midas_config = config.get_midas_config()
+
+	manifest: dict[str, BuildRecord] = {}
+	if not is_forced:
+		manifest = read_build_manifest()
+
+	builders = [build_shared_state_tree, build_shared_event_tree, build_client_boot, build_server_boot]
+	results: list[tuple[bool, float]] = []
+
+	# each builder writes to its own path, so the only shared state is the manifest which gets distinct keys
+	if is_concurrent:
+		with ThreadPoolExecutor(max_workers=len(builders)) as executor:
+			futures = [executor.submit(run_builder, builder, midas_config, manifest) for builder in builders]
+			results = [future.result() for future in futures]
+	else:
+		results = [run_builder(builder, midas_config, manifest) for builder in builders]
+
+	written_count = 0
+	for builder, (is_written, duration) in zip(builders, results):
+		status = "wrote" if is_written else "unchanged"
+		print(f"{builder.__name__}: {status} in {round(duration*1000)}ms")
+		if is_written:
+			written_count += 1
+
+	# the sourcemap covers every script, so it only needs regenerating once per build
+	if written_count > 0:
+		build_sourcemap()
 
-def main():
-	build_shared_state_tree()
-	build_shared_event_tree()
-	build_client_boot()
-	build_server_boot()
\ No newline at end of file
+	write_build_manifest(manifest)
@@ -3,8 +3,7 @@ import yaml
 import json
 import os
 import re
-from typing import TypedDict, Literal, Union, Optional, Any
-import keyring
+from typing import TypedDict, Literal, Union, Optional, NotRequired, Any
 from copy import deepcopy
 import dpath
 TrackerType = Literal["boolean", "integer", "double", "float", "string"]
@@ -37,6 +36,7 @@ class BuildConfig(TypedDict):
 	shared_state_tree_path: str
 	shared_event_tree_path: str
 	client_boot_script_path: str
+	compact_encoding: NotRequired[bool]
 
 class RecorderTargetConfig(TypedDict):
 	place_id: int
@@ -81,6 +81,17 @@ class AuthConfig(TypedDict):
 	aad: AADConfig
 	roblox: RobloxAuthConfig
 
+class TreeLeaf(TypedDict):
+	value: str | None
+	type: str
+	options: list[str] | None
+	is_nullable: bool
+
+class TreeIndex(TypedDict):
+	leaves: dict[str, TreeLeaf]
+	dictionaries: dict[str, list[str]]
+	boolean_arrays: dict[str, list[str]]
+
 def add_to_git_ignore(path: str, git_ignore_path=".gitignore"):
 	# Create a Path object for the .gitignore file
 	
@@ -92,8 +103,19 @@ def add_to_git_ignore(path: str, git_ignore_path=".gitignore"):
 		contents += "\n" + path
 		open(git_ignore_path, "w").write(contents)
 
+# persistent per-user cache shared by every project, since the one-file exe unpacks to a new temp folder each run
+def get_cache_dir(*sub_paths: str) -> str:
+	base_path = os.environ.get("LOCALAPPDATA", os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")))
+	cache_path = os.path.join(base_path, "midas", *sub_paths)
+	os.makedirs(cache_path, exist_ok=True)
+	return cache_path
+
 ENCODING_MARKER = "~"
 
+# kept here rather than in export, so the cli can list them without loading pandas
+OutputFormat = Literal["json", "ndjson", "parquet", "arrow"]
+OUTPUT_FORMATS: list[OutputFormat] = ["json", "ndjson", "parquet", "arrow"]
+
 CONFIG_TOML_PATH = "midas.yaml"
 
 TEMPLATE_STATE_TYPE_TREE = {
@@ -383,6 +405,7 @@ DEFAULT_CONFIG_TEMPLATE: MidasConfig = {
 		"shared_state_tree_path": "src/Shared/MidasStateTree.luau",
 		"shared_event_tree_path": "src/Shared/MidasEventTree.luau",
 		"client_boot_script_path": "src/Client/Analytics.client.luau",
+		"compact_encoding": False,
 	},
 	"monetization": {
 		"products": {
@@ -424,11 +447,38 @@ def init_file():
 	config_file.write(yaml.safe_dump(DEFAULT_CONFIG_TEMPLATE))
 	config_file.close()
 
+# parsed configs by absolute path, along with the file stats they were read from
+_midas_config_cache: dict[str, tuple[tuple[int, int], MidasConfig]] = {}
+
+def validate_midas_config(midas_config: Any):
+	assert isinstance(midas_config, dict), f"{CONFIG_TOML_PATH} is not a dictionary"
+	for key in MidasConfig.__annotations__:
+		assert key in midas_config, f"{CONFIG_TOML_PATH} is missing \"{key}\""
+	for key in BuildConfig.__required_keys__:
+		assert key in midas_config["build"], f"{CONFIG_TOML_PATH} is missing \"build/{key}\""
+	assert "State" in midas_config["template"] and "Event" in midas_config["template"], f"{CONFIG_TOML_PATH} template needs both State and Event"
+
+# the returned config is shared between callers, so treat it as read-only
 def get_midas_config() -> MidasConfig:
 	if not os.path.exists(CONFIG_TOML_PATH):
 		print("no midas.toml, have you initialized?")
 
-	untyped_config: Any = yaml.safe_load(open(CONFIG_TOML_PATH, "r").read())
+	abs_path = os.path.abspath(CONFIG_TOML_PATH)
+	stat = os.stat(abs_path)
+	file_key = (stat.st_mtime_ns, stat.st_size)
+
+	if abs_path in _midas_config_cache:
+		cached_key, cached_config = _midas_config_cache[abs_path]
+		if cached_key == file_key:
+			return cached_config
+
+	midas_config = load_midas_config(abs_path)
+	_midas_config_cache[abs_path] = (file_key, midas_config)
+	return midas_config
+
+def load_midas_config(config_path=CONFIG_TOML_PATH) -> MidasConfig:
+	untyped_config: Any = yaml.safe_load(open(config_path, "r").read())
+	validate_midas_config(untyped_config)
 	midas_config: Any = untyped_config
 
 	for path, value in dpath.search(TEMPLATE_STATE_TYPE_TREE, '**', yielded=True):
@@ -436,7 +486,7 @@ def get_midas_config() -> MidasConfig:
 		if status == None:
 			status = dpath.get(midas_config["template"]["Event"], path, default=None)
 		if (type(status) == bool and status == True) or type(status) == int:
-			dpath.new(midas_config["tree"], path, value)
+			dpath.new(midas_config["tree"], path, deepcopy(value))
 	
 	for gamepass_name in midas_config["monetization"]["gamepasses"]:
 		formatted_pass_name = re.sub(r'\s', '', gamepass_name)
@@ -461,9 +511,78 @@ def get_midas_config() -> MidasConfig:
 
 	return midas_config
 
+# the config the cached index was built from, compared by identity
+_tree_index_cache: tuple[Any, TreeIndex] | None = None
+
+def get_if_index_key(key: str) -> bool:
+	try:
+		int(key)
+		return True
+	except:
+		return False
+
+# yields the same (path, value) order as dpath.search(tree, '**'), without descending into lists
+def walk_tree(tree: dict, prefix=""):
+	for key, value in tree.items():
+		yield prefix + key, value
+
+	for key, value in tree.items():
+		if isinstance(value, dict):
+			yield from walk_tree(value, prefix + key + "/")
+
+def build_tree_index(tree: dict) -> TreeIndex:
+	tree_index: TreeIndex = {
+		"leaves": {},
+		"dictionaries": {},
+		"boolean_arrays": {},
+	}
+
+	for path, value in walk_tree(tree):
+		if isinstance(value, dict):
+			keys = list(value.keys())
+			tree_index["dictionaries"][path] = keys
+
+			is_all_boolean = True
+			for v in value.values():
+				if v != "boolean":
+					is_all_boolean = False
+			if is_all_boolean:
+				tree_index["boolean_arrays"][path] = keys
+
+		elif get_if_index_key(path.split("/")[-1]):
+			continue
+
+		elif type(value) == list:
+			tree_index["leaves"][path] = {
+				"value": None,
+				"type": "string",
+				"options": value,
+				"is_nullable": "nil" in value,
+			}
+
+		elif type(value) == str:
+			tree_index["leaves"][path] = {
+				"value": value,
+				"type": value.replace("?", ""),
+				"options": None,
+				"is_nullable": value.endswith("?"),
+			}
+
+	return tree_index
+
+def get_tree_index(midas_config: MidasConfig) -> TreeIndex:
+	global _tree_index_cache
+	if _tree_index_cache != None and _tree_index_cache[0] is midas_config:
+		return _tree_index_cache[1]
+
+	tree_index = build_tree_index(midas_config["tree"])
+	_tree_index_cache = (midas_config, tree_index)
+	return tree_index
+
 CREDENTIAL_USERNAME = os.path.abspath("") + "Midas"
 
 def get_auth_config() -> AuthConfig:
+	import keyring
 	title_id = keyring.get_password("title_id", CREDENTIAL_USERNAME)
 	dev_secret_key = keyring.get_password("dev_secret_key", CREDENTIAL_USERNAME)
 	client_id = keyring.get_password("client_id", CREDENTIAL_USERNAME)
@@ -0,0 +1,336 @@
+import os
+import re
+import json
+import bisect
+import multiprocessing
+from multiprocessing.pool import Pool
+from typing import Any
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+import midas.data_encoder as data_encoder
+import src.export as export
+import src.treecode as treecode
+from src.treecode import EncodingIndex, EncodingHistory, BuildVersion
+
+SHARD_KEY = "PlayFabUserId"
+MIN_ROWS_PER_SHARD = 2500
+MAX_ROWS_PER_CHUNK = 50000
+DEFAULT_WORKER_COUNT = os.cpu_count() or 1
+VERSION_KEY = "Version"
+VERSION_PART_KEYS = ["Major", "Minor", "Patch"]
+
+# pads packed binary strings out to the same width, it can never appear in one
+BINARY_PAD = " "
+BINARY_TRUE = ord("1")
+BINARY_PAD_CODE = ord(BINARY_PAD)
+
+# set within each worker process by the pool initializer so the indices are only sent once per worker, by source hash
+_worker_encoding_indices: dict[str, EncodingIndex] = {}
+
+def _init_worker(encoding_indices: dict[str, EncodingIndex]):
+	global _worker_encoding_indices
+	_worker_encoding_indices = encoding_indices
+
+def restore_keys(data: dict[str, Any], encoding_index: EncodingIndex) -> dict[str, Any]:
+	marker = encoding_index["marker"]
+	properties = encoding_index["properties"]
+
+	out = {}
+	for k, v in data.items():
+		if type(v) == dict:
+			v = restore_keys(v, encoding_index)
+
+		if k.startswith(marker):
+			k = properties.get(k.replace(marker, ""), k)
+
+		out[k] = v
+
+	return out
+
+def restore_values(data: dict[str, Any], encoding_index: EncodingIndex, prefix="", is_unpacking=True) -> dict[str, Any]:
+	marker = encoding_index["marker"]
+
+	out = {}
+	for k, v in data.items():
+		path = prefix + k
+		if type(v) == dict:
+			v = restore_values(v, encoding_index, path + "/", is_unpacking)
+		elif type(v) == str and marker in v:
+			if path in encoding_index["arrays"]:
+				if not is_unpacking:
+					out[k] = v
+					continue
+				# each character after the marker is one boolean, in the order the keys were registered
+				v = {key: v[i+len(marker)] == "1" for i, key in enumerate(encoding_index["arrays"][path])}
+			elif path in encoding_index["values"]:
+				v = encoding_index["values"][path].get(v.replace(marker, ""), v)
+
+		out[k] = v
+
+	return out
+
+# binary strings can be left packed for unpack_binary_strings to expand a whole column at once
+def decode_state(encoded_data: dict[str, Any], encoding_index: EncodingIndex, is_unpacking=True) -> dict[str, Any]:
+	return restore_values(restore_keys(encoded_data, encoding_index), encoding_index, is_unpacking=is_unpacking)
+
+# one row per packed string and one column per key, with a second matrix marking the bits each string actually had
+def unpack_binary_strings(packed_values: list[Any], key_count: int, marker: str) -> tuple[np.ndarray, np.ndarray]:
+	width = len(marker) + key_count
+	padded_text = "".join([value[:width].ljust(width, BINARY_PAD) if type(value) == str else BINARY_PAD*width for value in packed_values])
+
+	bit_codes = np.frombuffer(padded_text.encode("latin-1", errors="replace"), dtype=np.uint8).reshape(len(packed_values), width)[:, len(marker):]
+	is_true = bit_codes == BINARY_TRUE
+	is_present = bit_codes != BINARY_PAD_CODE
+	return is_true, is_present
+
+def get_array_columns(encoding_index: EncodingIndex, column_types: dict[str, str | list[str]]) -> dict[str, list[tuple[int, str]]]:
+	array_columns: dict[str, list[tuple[int, str]]] = {}
+	for path, keys in encoding_index["arrays"].items():
+		indexed_columns = [(key_index, export.STATE_COLUMN_PREFIX + path + "/" + key) for key_index, key in enumerate(keys)]
+		indexed_columns = [(key_index, column) for key_index, column in indexed_columns if column in column_types]
+		if len(indexed_columns) > 0:
+			array_columns[path] = indexed_columns
+
+	return array_columns
+
+def get_packed_value(state: Any, path_keys: list[str]) -> Any:
+	for key in path_keys:
+		if not isinstance(state, dict) or not key in state:
+			return None
+		state = state[key]
+	return state
+
+def get_unpacked_columns(packed_values: list[Any], indexed_columns: list[tuple[int, str]], keys: tuple[str, ...], marker: str) -> dict[str, Any]:
+	import pyarrow as pa
+
+	is_true, is_present = unpack_binary_strings(packed_values, len(keys), marker)
+
+	# a dictionary the game didn't pack is read key by key, like restore_values does
+	for row_index, value in enumerate(packed_values):
+		if isinstance(value, dict):
+			for key_index, key in enumerate(keys):
+				if key in value and type(value[key]) == bool:
+					is_true[row_index, key_index] = value[key]
+					is_present[row_index, key_index] = True
+
+	# arrow stores each column as bits, rather than a python bool per row
+	return {
+		column: pd.arrays.ArrowExtensionArray(pa.array(is_true[:, key_index], mask=~is_present[:, key_index], type=pa.bool_()))
+		for key_index, column in indexed_columns
+	}
+
+# matches data_encoder.decode_raw_df, with each code looked up in the compiled index rather than searched for
+def decode_events(raw_df: DataFrame, encoding_index: EncodingIndex) -> DataFrame:
+	raw_record_list: list[dict[str, Any]] = raw_df.to_dict(orient="records")
+
+	decoded_record_list = []
+	for raw_row_data in raw_record_list:
+		event_data = raw_row_data["EventData"]
+		if type(event_data) == str:
+			event_data = json.loads(data_encoder.format_json_str(event_data))
+
+		event_data["State"] = decode_state(event_data["State"], encoding_index)
+		decoded_record_list.append({
+			"EventData": event_data,
+			"SessionId": raw_row_data["SessionId"],
+			"Time": raw_row_data["Time"],
+			"Timestamp": raw_row_data["Timestamp"],
+			"PlayFabUserId": raw_row_data["PlayFabUserId"],
+			"EventName": raw_row_data["EventName"],
+			"EventId": raw_row_data["EventId"],
+		})
+
+	return DataFrame(decoded_record_list)
+
+# decodes straight into typed columns, without building a decoded EventData dict per event first
+def decode_typed_events(raw_df: DataFrame, encoding_index: EncodingIndex, column_types: dict[str, str | list[str]]) -> DataFrame:
+	columns = export.get_empty_columns(column_types)
+
+	# booleans in packed arrays skip the per row dictionaries and are unpacked a column at a time below
+	array_columns = get_array_columns(encoding_index, column_types)
+	packed_columns = set([column for indexed_columns in array_columns.values() for _, column in indexed_columns])
+	state_keys = {column: path_keys for column, path_keys in export.get_state_keys(column_types).items() if not column in packed_columns}
+	array_path_keys = {path: path.split("/") for path in array_columns}
+	packed_values: dict[str, list[Any]] = {path: [] for path in array_columns}
+
+	for raw_row_data in raw_df.to_dict(orient="records"):
+		event_data = raw_row_data["EventData"]
+		if type(event_data) == str:
+			event_data = json.loads(data_encoder.format_json_str(event_data))
+
+		state = decode_state(event_data.pop("State", {}), encoding_index, is_unpacking=False)
+		export.append_event(columns, raw_row_data, event_data, state, state_keys)
+		for path, path_keys in array_path_keys.items():
+			packed_values[path].append(get_packed_value(state, path_keys))
+
+	for path, indexed_columns in array_columns.items():
+		columns.update(get_unpacked_columns(packed_values[path], indexed_columns, encoding_index["arrays"][path], encoding_index["marker"]))
+
+	return export.get_typed_df(columns, column_types)
+
+def _decode_shard(shard: tuple[DataFrame, str]) -> DataFrame:
+	shard_df, source_hash = shard
+	decoded_df = decode_events(shard_df, _worker_encoding_indices[source_hash])
+	decoded_df.index = shard_df.index
+	return decoded_df
+
+def _decode_typed_chunk(chunk: tuple[DataFrame, dict[str, str | list[str]], str]) -> DataFrame:
+	chunk_df, column_types, source_hash = chunk
+	typed_df = decode_typed_events(chunk_df, _worker_encoding_indices[source_hash], column_types)
+	typed_df.index = chunk_df.index
+	return typed_df
+
+def get_shards(raw_df: DataFrame, shard_count: int, key=SHARD_KEY) -> list[DataFrame]:
+	shard_count = min(shard_count, max(1, len(raw_df.index) // MIN_ROWS_PER_SHARD))
+	if shard_count <= 1 or not key in raw_df.columns:
+		return [raw_df]
+
+	# keep every row of a user in the same shard
+	shard_ids = pd.util.hash_pandas_object(raw_df[key].astype(str), index=False) % shard_count
+	shards = []
+	for _, shard_df in raw_df.groupby(shard_ids, sort=True):
+		shards.append(shard_df)
+
+	return shards
+
+# a pool made from a history can decode rows of any version in it
+def create_pool(encoding: EncodingIndex | EncodingHistory, worker_count=DEFAULT_WORKER_COUNT) -> Pool:
+	encoding_indices = treecode.get_history_indices(treecode.to_encoding_history(encoding))
+	return multiprocessing.Pool(worker_count, initializer=_init_worker, initargs=(encoding_indices,))
+
+# keys are the marker and their code, possibly escaped, so starting with that literal lets re skip straight to it
+def get_key_pattern(marker: str, code: str) -> str:
+	return re.escape(marker + code) + r'\\?"\s*:\s*'
+
+def get_version_codes(encoding_index: EncodingIndex) -> tuple[str, ...] | None:
+	codes = {key: code for code, key in encoding_index["properties"].items()}
+	if not all(key in codes for key in [VERSION_KEY] + VERSION_PART_KEYS):
+		return None
+	return tuple(codes[key] for key in [VERSION_KEY] + VERSION_PART_KEYS)
+
+# reads each row's build version out of the still encoded EventData text, in one pass over the column per set of version codes
+def get_row_versions(raw_df: DataFrame, history: EncodingHistory) -> DataFrame:
+	event_data = raw_df["EventData"].map(lambda value: value if type(value) == str else json.dumps(value))
+
+	versions = DataFrame(index=raw_df.index, columns=VERSION_PART_KEYS, dtype="Int64")
+	version_code_sets = []
+	for encoding_index in [history["current"]] + [snapshot_index for _, snapshot_index in history["snapshots"]]:
+		version_codes = get_version_codes(encoding_index)
+		if version_codes != None and not (encoding_index["marker"], version_codes) in version_code_sets:
+			version_code_sets.append((encoding_index["marker"], version_codes))
+
+	# the version keys were among the first registered so their codes rarely differ, each differing set only fills the gaps
+	for marker, version_codes in version_code_sets:
+		version_objects = event_data.str.extract(get_key_pattern(marker, version_codes[0]) + r"\{([^{}]*)\}", expand=False)
+		for part_key, part_code in zip(VERSION_PART_KEYS, version_codes[1:]):
+			part_values = pd.to_numeric(version_objects.str.extract(get_key_pattern(marker, part_code) + r"(\d+)", expand=False), errors="coerce")
+			versions[part_key] = versions[part_key].fillna(part_values.astype("Int64"))
+
+	return versions
+
+def get_snapshot_index(build_version: BuildVersion, history: EncodingHistory) -> EncodingIndex:
+	snapshot_versions = [snapshot_version for snapshot_version, _ in history["snapshots"]]
+
+	# rows from a version without a snapshot use the latest snapshot before it, and anything newer uses the current encoding
+	position = bisect.bisect_right(snapshot_versions, build_version)
+	if position == 0 or position == len(snapshot_versions) and build_version > snapshot_versions[-1]:
+		return history["current"]
+	return history["snapshots"][position-1][1]
+
+# groups rows by the encoding their build sent them with, rather than deciding row by row
+def get_version_groups(raw_df: DataFrame, history: EncodingHistory) -> list[tuple[EncodingIndex, DataFrame]]:
+	if len(history["snapshots"]) == 0 or len(raw_df.index) == 0 or not "EventData" in raw_df.columns:
+		return [(history["current"], raw_df)]
+
+	versions = get_row_versions(raw_df, history)
+	is_versioned = versions.notna().all(axis=1)
+
+	source_hashes = pd.Series(history["current"]["source_hash"], index=raw_df.index)
+	if is_versioned.any():
+		version_labels = versions[is_versioned].astype(str).agg(".".join, axis=1)
+		label_hashes = {}
+		for label in version_labels.unique():
+			build_version = tuple(int(part) for part in label.split("."))
+			label_hashes[label] = get_snapshot_index((build_version[0], build_version[1], build_version[2]), history)["source_hash"]
+		source_hashes[is_versioned] = version_labels.map(label_hashes)
+
+	encoding_indices = treecode.get_history_indices(history)
+	return [(encoding_indices[source_hash], group_df) for source_hash, group_df in raw_df.groupby(source_hashes, sort=False)]
+
+def decode_index_df(raw_df: DataFrame, encoding_index: EncodingIndex, worker_count=DEFAULT_WORKER_COUNT, pool: Pool | None=None) -> DataFrame:
+	shards = get_shards(raw_df, worker_count)
+
+	if len(shards) <= 1:
+		decoded_df = decode_events(raw_df, encoding_index)
+		decoded_df.index = raw_df.index
+		return decoded_df
+
+	shard_args = [(shard_df, encoding_index["source_hash"]) for shard_df in shards]
+	if pool == None:
+		with create_pool(encoding_index, min(worker_count, len(shards))) as temp_pool:
+			decoded_shards = temp_pool.map(_decode_shard, shard_args)
+	else:
+		decoded_shards = pool.map(_decode_shard, shard_args)
+
+	return pd.concat(decoded_shards)
+
+def decode_raw_df(raw_df: DataFrame, encoding: EncodingIndex | EncodingHistory, worker_count=DEFAULT_WORKER_COUNT, pool: Pool | None=None) -> DataFrame:
+	history = treecode.to_encoding_history(encoding)
+	decoded_groups = [decode_index_df(group_df, encoding_index, worker_count, pool) for encoding_index, group_df in get_version_groups(raw_df, history)]
+
+	# restore the original row order
+	return pd.concat(decoded_groups).sort_index().reset_index(drop=True)
+
+# chunks keep the per-event python objects short lived, and are spread across the pool in order
+def decode_typed_df(
+	raw_df: DataFrame,
+	encoding: EncodingIndex | EncodingHistory,
+	column_types: dict[str, str | list[str]],
+	worker_count=DEFAULT_WORKER_COUNT,
+	pool: Pool | None=None,
+	is_compact=True
+) -> DataFrame:
+	history = treecode.to_encoding_history(encoding)
+	version_groups = get_version_groups(raw_df, history)
+
+	row_count = len(raw_df.index)
+	chunk_size = min(MAX_ROWS_PER_CHUNK, max(MIN_ROWS_PER_SHARD, -(-row_count // max(1, worker_count))))
+	chunks = []
+	for encoding_index, group_df in version_groups:
+		for start in range(0, len(group_df.index), chunk_size):
+			chunks.append((group_df.iloc[start:(start+chunk_size)], column_types, encoding_index["source_hash"]))
+
+	if len(chunks) == 0:
+		typed_df = export.get_typed_df(export.get_empty_columns(column_types), column_types)
+	elif len(chunks) == 1 or worker_count <= 1:
+		encoding_indices = treecode.get_history_indices(history)
+		typed_chunks = []
+		for chunk_df, chunk_column_types, source_hash in chunks:
+			typed_chunk_df = decode_typed_events(chunk_df, encoding_indices[source_hash], chunk_column_types)
+			typed_chunk_df.index = chunk_df.index
+			typed_chunks.append(typed_chunk_df)
+		typed_df = pd.concat(typed_chunks)
+	elif pool == None:
+		with create_pool(history, min(worker_count, len(chunks))) as temp_pool:
+			typed_df = pd.concat(temp_pool.map(_decode_typed_chunk, chunks))
+	else:
+		typed_df = pd.concat(pool.map(_decode_typed_chunk, chunks))
+
+	if len(version_groups) > 1:
+		typed_df = typed_df.sort_index()
+	typed_df = typed_df.reset_index(drop=True)
+
+	if is_compact:
+		typed_df = export.compact_typed_df(typed_df, column_types)
+	return typed_df
+
+# typed files get typed columns straight away, the writer casts them to its schema so narrowing each page would be wasted
+def write_page(writer: "export.Writer", df: DataFrame, encoding_index: EncodingIndex | EncodingHistory | None, worker_count=DEFAULT_WORKER_COUNT, pool: Pool | None=None):
+	if encoding_index != None and len(df.index) > 0 and isinstance(writer, export.ArrowWriter):
+		writer.write_typed(decode_typed_df(df, encoding_index, writer.column_types, worker_count, pool, is_compact=False))
+		return
+
+	if encoding_index != None and len(df.index) > 0:
+		df = decode_raw_df(df, encoding_index, worker_count, pool)
+	writer.write(df)
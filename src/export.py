@@ -0,0 +1,318 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from typing import Literal, Any
+import midas.data_encoder as data_encoder
+import src.config as config
+from src.config import MidasConfig, OutputFormat
+
+OUTPUT_FORMATS = config.OUTPUT_FORMATS
+DEFAULT_OUTPUT_FORMAT: OutputFormat = "json"
+APPENDABLE_FORMATS: list[OutputFormat] = ["json", "ndjson"]
+
+STATE_COLUMN_PREFIX = "State/"
+DOUBLE_DECIMAL_COUNT = 2
+INT32_MIN = -2**31
+INT32_MAX = 2**31 - 1
+
+# repeated on every event of a user or session, so a code per row is far smaller than a string per row
+CATEGORY_ROW_COLUMNS = ["SessionId", "PlayFabUserId", "EventName"]
+
+# string leaves that only ever hold a handful of values, like the Demographics languages
+CATEGORY_LEAF_SUFFIXES = ("Language",)
+ROW_COLUMN_TYPES = {
+	"Timestamp": "timestamp",
+	"Time": "float",
+	"SessionId": "string",
+	"PlayFabUserId": "string",
+	"EventName": "string",
+	"EventId": "string",
+	"EventData": "string",
+}
+
+# with paths, only the leaves under them get a column
+def get_column_types(midas_config: MidasConfig, paths: list[str] | None=None) -> dict[str, str | list[str]]:
+	column_types: dict[str, str | list[str]] = {}
+	for path, leaf in config.get_tree_index(midas_config)["leaves"].items():
+		if paths != None and len(paths) > 0 and not any(path == selected_path or path.startswith(selected_path + "/") for selected_path in paths):
+			continue
+		if leaf["options"] != None:
+			column_types[STATE_COLUMN_PREFIX + path] = [v for v in leaf["options"] if v != "nil"]
+		else:
+			column_types[STATE_COLUMN_PREFIX + path] = leaf["type"]
+
+	return column_types
+
+# booleans are kept as bit-packed arrow arrays and strings in one arrow buffer, rather than a python object per value
+def get_pandas_dtype(tree_type: str | list[str]) -> Any:
+	if type(tree_type) == list:
+		return pd.CategoricalDtype(categories=tree_type)
+	elif tree_type == "integer":
+		return "Int64"
+	elif tree_type == "double" or tree_type == "float":
+		return "Float64"
+	elif tree_type == "boolean":
+		return "bool[pyarrow]"
+	elif tree_type == "timestamp":
+		return "datetime64[ns, UTC]"
+	return "string[pyarrow]"
+
+def get_arrow_type(tree_type: str | list[str]) -> Any:
+	import pyarrow as pa
+	if type(tree_type) == list:
+		return pa.dictionary(pa.int32(), pa.string())
+	elif tree_type == "integer":
+		return pa.int64()
+	elif tree_type == "double" or tree_type == "float":
+		return pa.float64()
+	elif tree_type == "boolean":
+		return pa.bool_()
+	elif tree_type == "timestamp":
+		return pa.timestamp("us", tz="UTC")
+	return pa.string()
+
+def get_state_value(state: Any, path_keys: list[str]) -> Any:
+	for key in path_keys:
+		if not isinstance(state, dict) or not key in state:
+			return None
+		state = state[key]
+
+	if isinstance(state, dict) or isinstance(state, list):
+		return None
+	return state
+
+def get_empty_columns(column_types: dict[str, str | list[str]]) -> dict[str, list]:
+	columns: dict[str, list] = {}
+	for column in ROW_COLUMN_TYPES:
+		columns[column] = []
+	for column in column_types:
+		columns[column] = []
+
+	return columns
+
+def get_state_keys(column_types: dict[str, str | list[str]]) -> dict[str, list[str]]:
+	return {column: column[len(STATE_COLUMN_PREFIX):].split("/") for column in column_types}
+
+def append_event(columns: dict[str, list], record: dict, event_data: Any, state: Any, state_keys: dict[str, list[str]]):
+	for column in ROW_COLUMN_TYPES:
+		if column == "EventData":
+			columns[column].append(json.dumps(event_data) if event_data != None else None)
+		else:
+			columns[column].append(record.get(column, None))
+
+	for column, path_keys in state_keys.items():
+		columns[column].append(get_state_value(state, path_keys))
+
+def get_typed_df(columns: dict[str, list], column_types: dict[str, str | list[str]]) -> DataFrame:
+	typed_df = DataFrame(columns)
+	for column, tree_type in list(ROW_COLUMN_TYPES.items()) + list(column_types.items()):
+		dtype = get_pandas_dtype(tree_type)
+		if dtype == "Int64":
+			typed_df[column] = pd.to_numeric(typed_df[column], errors="coerce").round()
+		elif dtype == "Float64":
+			typed_df[column] = pd.to_numeric(typed_df[column], errors="coerce")
+		elif tree_type == "timestamp":
+			typed_df[column] = pd.to_datetime(typed_df[column], utc=True, errors="coerce", format="ISO8601")
+		typed_df[column] = typed_df[column].astype(dtype)
+
+	return typed_df
+
+# raw events are still encoded, so their EventData is kept whole for decoding later
+def get_raw_event_data(event_data: Any) -> str | None:
+	if type(event_data) == str:
+		return data_encoder.format_json_str(event_data)
+	elif event_data != None:
+		return json.dumps(event_data)
+	return None
+
+def to_typed_df(df: DataFrame, column_types: dict[str, str | list[str]]) -> DataFrame:
+	records: list[dict] = df.to_dict(orient="records")
+	columns = get_empty_columns(column_types)
+	state_keys = get_state_keys(column_types)
+
+	# without state columns there is nowhere else for the state to go
+	is_raw = len(column_types) == 0
+
+	for record in records:
+		event_data = record.get("EventData", None)
+		if is_raw:
+			for column in ROW_COLUMN_TYPES:
+				columns[column].append(get_raw_event_data(event_data) if column == "EventData" else record.get(column, None))
+			continue
+
+		if type(event_data) == str:
+			event_data = json.loads(event_data)
+
+		state = {}
+		if isinstance(event_data, dict):
+			state = event_data.get("State", {})
+			event_data = {k: v for k, v in event_data.items() if k != "State"}
+
+		append_event(columns, record, event_data, state, state_keys)
+
+	return get_typed_df(columns, column_types)
+
+def get_if_float32_safe(values: Any) -> bool:
+	# doubles are rounded in game, so float32 is enough as long as every value comes back to the same rounding
+	values = values.dropna().to_numpy(dtype="float64")
+	rounded_values = np.round(values, DOUBLE_DECIMAL_COUNT)
+	if not np.array_equal(values, rounded_values):
+		return False
+	return bool(np.array_equal(np.round(values.astype("float32").astype("float64"), DOUBLE_DECIMAL_COUNT), rounded_values))
+
+def get_if_category_column(column: str, tree_type: str | list[str]) -> bool:
+	if column in CATEGORY_ROW_COLUMNS:
+		return True
+	return tree_type == "string" and column.split("/")[-1].endswith(CATEGORY_LEAF_SUFFIXES)
+
+# narrows each column once the whole frame is known, since a chunk alone can't tell if a value will overflow
+def compact_typed_df(typed_df: DataFrame, column_types: dict[str, str | list[str]]) -> DataFrame:
+	for column, tree_type in list(ROW_COLUMN_TYPES.items()) + list(column_types.items()):
+		values = typed_df[column]
+		if get_if_category_column(column, tree_type):
+			typed_df[column] = values.astype("category")
+		elif values.dtype == "Int64":
+			if values.isna().all() or (values.min() >= INT32_MIN and values.max() <= INT32_MAX):
+				typed_df[column] = values.astype("Int32")
+		elif tree_type == "double" and get_if_float32_safe(values):
+			typed_df[column] = values.astype("Float32")
+
+	return typed_df
+
+class JSONArrayWriter():
+	def __init__(self, path: str, append=False):
+		self.path = path
+		self.row_count = 0
+		self.has_rows = False
+
+		if append and os.path.exists(path):
+			# reopen the array by dropping the closing bracket of a finished file
+			with open(path, "rb+") as existing_file:
+				existing_file.seek(0, os.SEEK_END)
+				size = existing_file.tell()
+				existing_file.seek(max(0, size-2))
+				if existing_file.read() == b"\n]":
+					size -= 2
+					existing_file.truncate(size)
+				self.has_rows = size > 2
+				if not self.has_rows:
+					existing_file.truncate(0)
+			self.file = open(path, "a")
+		else:
+			self.file = open(path, "w")
+
+	def write(self, df: DataFrame):
+		if len(df.index) == 0:
+			return
+
+		# pandas wraps the records in "[\n" and "\n]", strip them so chunks can be joined
+		text = df.to_json(indent=4, orient="records")
+		text = text[2:(len(text)-2)]
+
+		if not self.has_rows:
+			self.file.write("[\n" + text)
+		else:
+			self.file.write(",\n" + text)
+
+		self.file.flush()
+		self.row_count += len(df.index)
+		self.has_rows = True
+
+	def close(self):
+		if not self.has_rows:
+			self.file.write("[\n")
+		self.file.write("\n]")
+		self.file.close()
+
+class NDJSONWriter():
+	def __init__(self, path: str, append=False):
+		self.path = path
+		self.row_count = 0
+		self.file = open(path, "a" if append else "w")
+
+	def write(self, df: DataFrame):
+		if len(df.index) == 0:
+			return
+
+		self.file.write(df.to_json(orient="records", lines=True))
+		self.file.flush()
+		self.row_count += len(df.index)
+
+	def close(self):
+		self.file.close()
+
+class ArrowWriter():
+	def __init__(self, path: str, column_types: dict[str, str | list[str]], output_format: Literal["parquet", "arrow"]):
+		import pyarrow as pa
+		import pyarrow.parquet as pq
+		self.path = path
+		self.row_count = 0
+		self.column_types = column_types
+		self.schema = pa.schema(
+			[(column, get_arrow_type(tree_type)) for column, tree_type in ROW_COLUMN_TYPES.items()]
+			+ [(column, get_arrow_type(tree_type)) for column, tree_type in column_types.items()]
+		)
+		if output_format == "parquet":
+			self.writer = pq.ParquetWriter(path, self.schema)
+		else:
+			self.writer = pa.ipc.new_file(path, self.schema)
+
+	def write(self, df: DataFrame):
+		if len(df.index) == 0:
+			return
+		self.write_typed(to_typed_df(df, self.column_types))
+
+	# takes frames already decoded to typed columns, which arrow casts back to the file's schema
+	def write_typed(self, typed_df: DataFrame):
+		import pyarrow as pa
+		if len(typed_df.index) == 0:
+			return
+
+		# narrowed doubles are widened back to the rounding they were sent with, not float32's nearest value
+		float32_columns = [column for column, dtype in typed_df.dtypes.items() if dtype == "Float32"]
+		if len(float32_columns) > 0:
+			typed_df = typed_df.copy(deep=False)
+			for column in float32_columns:
+				typed_df[column] = typed_df[column].astype("Float64").round(DOUBLE_DECIMAL_COUNT)
+
+		# playfab sends tenths of microseconds, which the file's microsecond column would otherwise refuse to cut
+		timestamp_columns = [column for column, tree_type in ROW_COLUMN_TYPES.items() if tree_type == "timestamp"]
+		typed_df = typed_df.copy(deep=False)
+		for column in timestamp_columns:
+			typed_df[column] = typed_df[column].dt.floor("us")
+
+		table = pa.Table.from_pandas(typed_df, schema=self.schema, preserve_index=False)
+		self.writer.write_table(table)
+		self.row_count += len(typed_df.index)
+
+	def close(self):
+		self.writer.close()
+
+Writer = JSONArrayWriter | NDJSONWriter | ArrowWriter
+
+def get_writer(path: str, output_format: OutputFormat, midas_config: MidasConfig | None=None, append=False, paths: list[str] | None=None) -> Writer:
+	assert output_format in OUTPUT_FORMATS, f"{output_format} is not one of {', '.join(OUTPUT_FORMATS)}"
+	assert not append or output_format in APPENDABLE_FORMATS, f"{output_format} files can't be appended to"
+
+	if output_format == "json":
+		return JSONArrayWriter(path, append)
+	elif output_format == "ndjson":
+		return NDJSONWriter(path, append)
+
+	# raw downloads are still encoded, so there are no state columns to type
+	column_types = {}
+	if midas_config != None:
+		column_types = get_column_types(midas_config, paths)
+
+	return ArrowWriter(path, column_types, output_format)
+
+def write_df(df: DataFrame, path: str, output_format: OutputFormat, midas_config: MidasConfig | None=None):
+	if output_format == "json":
+		df.to_json(path, indent=4, orient="records")
+		return
+
+	writer = get_writer(path, output_format, midas_config)
+	writer.write(df)
+	writer.close()
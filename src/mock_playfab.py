@@ -0,0 +1,262 @@
+import re
+import json
+import time
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any
+from azure.kusto.data import KustoClient, KustoConnectionStringBuilder
+from midas.playfab import get_datetime_from_playfab_str
+import src.synthetic as synthetic
+from src.config import MidasConfig
+from src.projection import PlayFabQueryClient
+
+MOCK_HOST = "127.0.0.1"
+MOCK_PORT = 8080
+MOCK_TITLE_ID = "MOCK"
+MOCK_USER_COUNT = 1000
+MOCK_EVENTS_PER_USER = 100
+MOCK_JOIN_WINDOW_IN_DAYS = 30
+QUERY_PATH = "/v1/rest/query"
+
+USER_COLUMNS = [("PlayFabUserId", "string"), ("JoinTimestamp", "datetime"), ("EventCount", "long")]
+EVENT_COLUMNS = [
+	("Timestamp", "datetime"),
+	("Time", "real"),
+	("SessionId", "string"),
+	("EventData", "dynamic"),
+	("EventName", "string"),
+	("PlayFabUserId", "string"),
+	("EventId", "string"),
+]
+EVENT_DATA_INDEX = [column for column, _ in EVENT_COLUMNS].index("EventData")
+EVENT_NAME_INDEX = [column for column, _ in EVENT_COLUMNS].index("EventName")
+
+# the values PlayFabClient writes into its two queries
+USER_FLOOR_PATTERN = re.compile(r'filter_users_who_joined_before\s*=\s*datetime\("([^"]+)"\)')
+JOIN_WINDOW_PATTERN = re.compile(r'let join_window_in_days\s*=\s*(\d+);')
+USER_LIMIT_PATTERN = re.compile(r'let user_limit\s*=\s*(\d+);')
+USER_IDS_PATTERN = re.compile(r'let playfab_user_ids\s*=\s*dynamic\((\[.*?\])\);', re.DOTALL)
+EVENT_FLOOR_PATTERN = re.compile(r'let only_events_after\s*=\s*datetime\("([^"]+)"\)')
+
+# the filters midas download -select and -event add to the end of the event query
+EVENT_NAMES_PATTERN = re.compile(r'\| where EventName in \(dynamic\((\[.*?\])\)\)')
+PROJECTION_PATTERN = re.compile(r'\| extend EventData = bag_merge\(bag_remove_keys\(EventData')
+SELECTED_VALUE_PATTERN = re.compile(r'iff\(isnull\((EventData\.State(?:\["[^"\]]*"\])+)\), dynamic\(\{\}\), bag_pack\("[^"]*", \1\)\)')
+KEY_PATTERN = re.compile(r'\["([^"\]]*)"\]')
+
+def to_naive_utc(value: datetime) -> datetime:
+	if value.tzinfo != None:
+		value = value.astimezone(timezone.utc).replace(tzinfo=None)
+	return value
+
+class MockDataset():
+	def __init__(
+		self,
+		midas_config: MidasConfig,
+		encoding_tree: Any,
+		user_count=MOCK_USER_COUNT,
+		events_per_user=MOCK_EVENTS_PER_USER,
+		join_window_in_days=MOCK_JOIN_WINDOW_IN_DAYS,
+		seed=0,
+		start=synthetic.SYNTHETIC_START
+	):
+		self.seed = seed
+		self.event_data_pool = synthetic.get_synthetic_event_data_pool(midas_config, encoding_tree, seed=seed)
+
+		# users join evenly across the window, each with a repeatable number of events averaging events_per_user
+		join_spacing = timedelta(days=join_window_in_days) / (user_count + 1)
+		self.users: list[tuple[str, datetime, int]] = []
+		for user_index, user_id in enumerate(synthetic.get_synthetic_user_ids(user_count, seed)):
+			rng = random.Random(f"{seed}/{user_id}/count")
+			event_count = rng.randint(1, max(1, 2*events_per_user - 1))
+			self.users.append((user_id, start + join_spacing*(user_index+1), event_count))
+
+		self.users_by_id = {user[0]: user for user in self.users}
+
+	def get_user_rows(self, user_join_floor: datetime, join_window_in_days: int, user_limit: int) -> list[list[Any]]:
+		join_ceiling = user_join_floor + timedelta(days=join_window_in_days)
+		users = [user for user in self.users if user_join_floor < user[1] < join_ceiling][:user_limit]
+		users.sort(key=lambda user: user[2], reverse=True)
+		return [[user_id, join_timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), event_count] for user_id, join_timestamp, event_count in users]
+
+	def get_event_rows(self, user_ids: list[str], events_after: datetime) -> list[list[Any]]:
+		rows = []
+		for user_id in user_ids:
+			if not user_id in self.users_by_id:
+				continue
+			_, join_timestamp, event_count = self.users_by_id[user_id]
+			for event in synthetic.get_synthetic_user_events(user_id, event_count, join_timestamp, self.event_data_pool, self.seed):
+				if datetime.strptime(event["Timestamp"], "%Y-%m-%dT%H:%M:%S.%fZ") > events_after:
+					rows.append([event[column] for column, _ in EVENT_COLUMNS])
+
+		return rows
+
+def get_selected_key_paths(query: str) -> list[list[str]] | None:
+	if PROJECTION_PATTERN.search(query) == None:
+		return None
+	return [KEY_PATTERN.findall(match.group(1)) for match in SELECTED_VALUE_PATTERN.finditer(query)]
+
+def get_projected_event_data(event_data_text: str, key_paths: list[list[str]]) -> str:
+	event_data = json.loads(event_data_text)
+	state = event_data.get("State", {})
+
+	projected_state: dict[str, Any] = {}
+	for key_path in key_paths:
+		source: Any = state
+		target = projected_state
+		for index, key in enumerate(key_path):
+			if not isinstance(source, dict) or not key in source:
+				break
+			source = source[key]
+			if index == len(key_path)-1:
+				target[key] = source
+			else:
+				target = target.setdefault(key, {})
+
+	event_data["State"] = projected_state
+	return json.dumps(event_data)
+
+def get_table_response(columns: list[tuple[str, str]], rows: list[list[Any]]) -> dict:
+	return {
+		"Tables": [{
+			"TableName": "Table_0",
+			"Columns": [{"ColumnName": name, "DataType": column_type, "ColumnType": column_type} for name, column_type in columns],
+			"Rows": rows,
+		}]
+	}
+
+def get_error_response(code: str, message: str) -> dict:
+	return {"error": {"code": code, "message": message, "@type": f"Kusto.Data.Exceptions.{code}", "@message": message}}
+
+class MockQueryHandler(BaseHTTPRequestHandler):
+	server: "MockKustoServer"
+
+	def send_json(self, status: int, data: dict):
+		body = json.dumps(data).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_POST(self):
+		if self.path.rstrip("/") != QUERY_PATH:
+			self.send_json(404, get_error_response("NotFound", f"{self.path} does not exist"))
+			return
+
+		request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+		query: str = request.get("csl", "")
+
+		if not self.server.try_start_request():
+			self.send_json(429, get_error_response("ThrottlingException", "too many concurrent requests"))
+			print("throttled a query")
+			return
+
+		try:
+			start_tick = time.perf_counter()
+			if self.server.latency > 0:
+				time.sleep(self.server.latency)
+
+			user_ids_match = USER_IDS_PATTERN.search(query)
+			user_floor_match = USER_FLOOR_PATTERN.search(query)
+			if user_ids_match != None:
+				event_floor_match = EVENT_FLOOR_PATTERN.search(query)
+				events_after = to_naive_utc(get_datetime_from_playfab_str(event_floor_match.group(1))) if event_floor_match != None else datetime.min
+				columns, rows = EVENT_COLUMNS, self.server.dataset.get_event_rows(json.loads(user_ids_match.group(1)), events_after)
+
+				event_names_match = EVENT_NAMES_PATTERN.search(query)
+				if event_names_match != None:
+					event_names = set(json.loads(event_names_match.group(1)))
+					rows = [row for row in rows if row[EVENT_NAME_INDEX] in event_names]
+
+				key_paths = get_selected_key_paths(query)
+				if key_paths != None:
+					for row in rows:
+						row[EVENT_DATA_INDEX] = get_projected_event_data(row[EVENT_DATA_INDEX], key_paths)
+			elif user_floor_match != None:
+				join_window_match = JOIN_WINDOW_PATTERN.search(query)
+				user_limit_match = USER_LIMIT_PATTERN.search(query)
+				columns, rows = USER_COLUMNS, self.server.dataset.get_user_rows(
+					to_naive_utc(get_datetime_from_playfab_str(user_floor_match.group(1))),
+					int(join_window_match.group(1)) if join_window_match != None else MOCK_JOIN_WINDOW_IN_DAYS,
+					int(user_limit_match.group(1)) if user_limit_match != None else len(self.server.dataset.users)
+				)
+			else:
+				self.send_json(400, get_error_response("BadRequestException", "the mock server only answers the user and event queries sent by PlayFabClient"))
+				return
+
+			# mirrors kusto refusing result sets above its record limit, which is what drives the download backoff
+			if self.server.max_rows > 0 and len(rows) > self.server.max_rows:
+				self.send_json(400, get_error_response("LimitsExceededException", f"query result set has exceeded the record limit of {self.server.max_rows}"))
+				print(f"refused a query returning {len(rows)} rows")
+				return
+
+			self.send_json(200, get_table_response(columns, rows))
+			print(f"answered with {len(rows)} rows in {round((time.perf_counter()-start_tick)*1000)}ms")
+		finally:
+			self.server.finish_request_slot()
+
+	def log_message(self, format: str, *args: Any):
+		pass
+
+class MockKustoServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, dataset: MockDataset, host=MOCK_HOST, port=MOCK_PORT, latency=0.0, max_rows=0, max_concurrent=0):
+		super().__init__((host, port), MockQueryHandler)
+		self.dataset = dataset
+		self.latency = latency
+		self.max_rows = max_rows
+		self.max_concurrent = max_concurrent
+		self.active_request_count = 0
+		self.request_lock = threading.Lock()
+
+	def try_start_request(self) -> bool:
+		with self.request_lock:
+			if self.max_concurrent > 0 and self.active_request_count >= self.max_concurrent:
+				return False
+			self.active_request_count += 1
+			return True
+
+	def finish_request_slot(self):
+		with self.request_lock:
+			self.active_request_count -= 1
+
+# queries a local endpoint with the same kusto client and queries as PlayFabClient, without signing in to aad
+class LocalPlayFabClient(PlayFabQueryClient):
+	def __init__(self, endpoint: str, title_id=MOCK_TITLE_ID):
+		self.title_id = title_id
+		self.client_id = ""
+		self.client_secret = ""
+		self.tenant_id = ""
+
+		kcsb = KustoConnectionStringBuilder.with_aad_application_token_authentication(endpoint, "local")
+		self.client = KustoClient(kcsb)
+		self.client._query_endpoint = endpoint.rstrip("/") + QUERY_PATH
+
+def main(
+	midas_config: MidasConfig,
+	encoding_tree: Any,
+	port=MOCK_PORT,
+	user_count=MOCK_USER_COUNT,
+	events_per_user=MOCK_EVENTS_PER_USER,
+	join_window_in_days=MOCK_JOIN_WINDOW_IN_DAYS,
+	latency=0.0,
+	max_rows=0,
+	max_concurrent=0,
+	seed=0
+):
+	dataset = MockDataset(midas_config, encoding_tree, user_count, events_per_user, join_window_in_days, seed)
+	server = MockKustoServer(dataset, MOCK_HOST, port, latency, max_rows, max_concurrent)
+
+	event_count = sum([user[2] for user in dataset.users])
+	print(f"serving {user_count} users and {event_count} events at http://{MOCK_HOST}:{port}")
+	print(f"users joined in the {join_window_in_days} days after {synthetic.SYNTHETIC_START.strftime('%Y-%m-%d %H:%M:%S')}, stop with ctrl+c")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
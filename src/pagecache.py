@@ -0,0 +1,248 @@
+import os
+import json
+import gzip
+import sqlite3
+import hashlib
+from datetime import datetime, timezone
+from typing import Iterator, TypedDict, Any
+from pandas import DataFrame
+import src.config as config
+import src.decode as decode
+import src.export as export
+import src.projection as projection
+from src.config import MidasConfig
+from src.export import OutputFormat
+from src.projection import Selection
+from src.treecode import EncodingIndex, EncodingHistory
+
+PAGE_CACHE_PATH = "midas.pages"
+PAGE_CACHE_VERSION = 1
+SEGMENT_DIR_NAME = "segments"
+SEGMENT_EXTENSION = ".ndjson.gz"
+INDEX_FILE_NAME = "index.db"
+
+# the index is read through a memory map rather than copied into sqlite's own page cache
+INDEX_MMAP_SIZE = 256*1024*1024
+
+class SliceInfo(TypedDict):
+	slice_key: str
+	title_id: str
+	user_join_floor: str
+	join_window_in_days: int
+	user_limit: int
+	created_at: str
+	page_count: int
+	event_count: int
+	is_complete: bool
+
+# the query text comes from the installed midas-data-util, so a new version of it starts a new slice
+def get_query_version() -> str:
+	from importlib.metadata import version, PackageNotFoundError
+	try:
+		return version("midas-data-util")
+	except PackageNotFoundError:
+		return "unknown"
+
+def get_slice_key(
+	title_id: str,
+	user_join_floor: datetime,
+	join_window_in_days: int,
+	user_limit: int,
+	user_watermarks: dict[str, datetime] | None=None,
+	selection: Selection | None=None
+) -> str:
+	if user_watermarks == None:
+		user_watermarks = {}
+
+	params = {
+		"version": PAGE_CACHE_VERSION,
+		"query": get_query_version(),
+		"title_id": title_id,
+		"user_join_floor": user_join_floor,
+		"join_window_in_days": join_window_in_days,
+		"user_limit": user_limit,
+		"user_watermarks": user_watermarks,
+	}
+
+	# only added when there is one, so unfiltered downloads keep the keys they had before selections existed
+	if selection != None:
+		params["selection"] = projection.get_selection_params(selection)
+	return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def get_segment_bytes(page: list[Any]) -> bytes:
+	return "".join([json.dumps(row, default=str) + "\n" for row in page]).encode("utf-8")
+
+class PageCache():
+	def __init__(self, path=PAGE_CACHE_PATH):
+		self.path = path
+		self.segment_path = os.path.join(path, SEGMENT_DIR_NAME)
+
+		is_new = not os.path.exists(path)
+		os.makedirs(self.segment_path, exist_ok=True)
+
+		self.connection = sqlite3.connect(os.path.join(path, INDEX_FILE_NAME))
+		self.connection.execute(f"PRAGMA mmap_size = {INDEX_MMAP_SIZE}")
+		self.connection.executescript("""
+			CREATE TABLE IF NOT EXISTS slices (
+				slice_key TEXT PRIMARY KEY,
+				title_id TEXT NOT NULL,
+				user_join_floor TEXT NOT NULL,
+				join_window_in_days INTEGER NOT NULL,
+				user_limit INTEGER NOT NULL,
+				created_at TEXT NOT NULL,
+				is_complete INTEGER NOT NULL DEFAULT 0
+			);
+			CREATE TABLE IF NOT EXISTS pages (
+				slice_key TEXT NOT NULL,
+				page_index INTEGER NOT NULL,
+				segment_hash TEXT NOT NULL,
+				row_count INTEGER NOT NULL,
+				PRIMARY KEY (slice_key, page_index)
+			);
+		""")
+		self.connection.commit()
+
+		if is_new and os.path.exists(".gitignore"):
+			config.add_to_git_ignore(path)
+
+	def start_slice(
+		self,
+		slice_key: str,
+		title_id: str,
+		user_join_floor: datetime,
+		join_window_in_days: int,
+		user_limit: int,
+		is_append=False
+	):
+		# resumed downloads add to the pages already kept, anything else replaces them
+		if not is_append:
+			self.connection.execute("DELETE FROM pages WHERE slice_key = ?", (slice_key,))
+		self.connection.execute(
+			"""INSERT INTO slices (slice_key, title_id, user_join_floor, join_window_in_days, user_limit, created_at, is_complete) VALUES (?, ?, ?, ?, ?, ?, 0)
+			ON CONFLICT(slice_key) DO UPDATE SET created_at = excluded.created_at, is_complete = 0""",
+			(slice_key, title_id, str(user_join_floor), join_window_in_days, user_limit, datetime.now(timezone.utc).isoformat())
+		)
+		self.connection.commit()
+
+	def get_segment_file_path(self, segment_hash: str) -> str:
+		return os.path.join(self.segment_path, segment_hash + SEGMENT_EXTENSION)
+
+	# segments are named by their contents, so a page fetched again by another slice is only stored once
+	def add_page(self, slice_key: str, page: list[Any]) -> str:
+		segment_bytes = get_segment_bytes(page)
+		segment_hash = hashlib.sha1(segment_bytes).hexdigest()
+
+		segment_file_path = self.get_segment_file_path(segment_hash)
+		if not os.path.exists(segment_file_path):
+			tmp_path = f"{segment_file_path}.{os.getpid()}.tmp"
+			with gzip.open(tmp_path, "wb") as segment_file:
+				segment_file.write(segment_bytes)
+			os.replace(tmp_path, segment_file_path)
+
+		page_index = self.connection.execute("SELECT COUNT(*) FROM pages WHERE slice_key = ?", (slice_key,)).fetchone()[0]
+		self.connection.execute(
+			"INSERT INTO pages (slice_key, page_index, segment_hash, row_count) VALUES (?, ?, ?, ?)",
+			(slice_key, page_index, segment_hash, len(page))
+		)
+		self.connection.commit()
+		return segment_hash
+
+	def finish_slice(self, slice_key: str):
+		self.connection.execute("UPDATE slices SET is_complete = 1 WHERE slice_key = ?", (slice_key,))
+		self.connection.commit()
+
+	def get_slices(self) -> list[SliceInfo]:
+		rows = self.connection.execute("""
+			SELECT s.slice_key, s.title_id, s.user_join_floor, s.join_window_in_days, s.user_limit, s.created_at, COUNT(p.page_index), COALESCE(SUM(p.row_count), 0), s.is_complete
+			FROM slices s LEFT JOIN pages p ON p.slice_key = s.slice_key
+			GROUP BY s.slice_key
+			ORDER BY s.created_at DESC
+		""").fetchall()
+
+		return [{
+			"slice_key": row[0],
+			"title_id": row[1],
+			"user_join_floor": row[2],
+			"join_window_in_days": row[3],
+			"user_limit": row[4],
+			"created_at": row[5],
+			"page_count": row[6],
+			"event_count": row[7],
+			"is_complete": row[8] == 1,
+		} for row in rows]
+
+	def get_slice_key(self, key_prefix: str | None=None) -> str:
+		slices = self.get_slices()
+		if key_prefix != None:
+			matches = [slice_info["slice_key"] for slice_info in slices if slice_info["slice_key"].startswith(key_prefix)]
+			assert len(matches) > 0, f"no cached download starts with {key_prefix}"
+			assert len(matches) == 1, f"{key_prefix} matches {len(matches)} cached downloads, use more of the key"
+			return matches[0]
+
+		complete_slices = [slice_info["slice_key"] for slice_info in slices if slice_info["is_complete"]]
+		assert len(complete_slices) > 0, f"{self.path} has no finished downloads to decode"
+		return complete_slices[0]
+
+	def iterate_pages(self, slice_key: str) -> Iterator[list[dict[str, Any]]]:
+		segment_hashes = self.connection.execute(
+			"SELECT segment_hash FROM pages WHERE slice_key = ? ORDER BY page_index",
+			(slice_key,)
+		).fetchall()
+
+		for (segment_hash,) in segment_hashes:
+			with gzip.open(self.get_segment_file_path(segment_hash), "rb") as segment_file:
+				yield [json.loads(line) for line in segment_file if len(line.strip()) > 0]
+
+	def close(self):
+		self.connection.close()
+
+# passes pages through untouched, marking the slice once every page is in
+def iterate_cached_pages(pages: Iterator[tuple[list[str], list[Any]]], page_cache: "PageCache", slice_key: str) -> Iterator[tuple[list[str], list[Any]]]:
+	for user_ids, page in pages:
+		yield user_ids, page
+
+		# only reached once the consumer has written the page, so a page that failed isn't kept to be fetched again on resume
+		page_cache.add_page(slice_key, page)
+	page_cache.finish_slice(slice_key)
+
+def print_slices(page_cache: PageCache):
+	slices = page_cache.get_slices()
+	if len(slices) == 0:
+		print(f"{page_cache.path} has no cached downloads")
+		return
+
+	for slice_info in slices:
+		status = "complete" if slice_info["is_complete"] else "incomplete"
+		print(
+			f"{slice_info['slice_key'][:12]}  {slice_info['title_id']}  users joined {slice_info['join_window_in_days']} days after {slice_info['user_join_floor']}"
+			+ f", {slice_info['event_count']} events in {slice_info['page_count']} pages, {status}, fetched {slice_info['created_at']}"
+		)
+
+# decodes a cached download page by page, exactly as the download itself would have
+def decode_slice(
+	page_cache: PageCache,
+	slice_key: str,
+	path: str,
+	encoding_index: EncodingIndex | EncodingHistory | None,
+	output_format: OutputFormat=export.DEFAULT_OUTPUT_FORMAT,
+	midas_config: MidasConfig | None=None,
+	worker_count=decode.DEFAULT_WORKER_COUNT,
+	paths: list[str] | None=None
+) -> int:
+	writer = export.get_writer(os.path.abspath(path), output_format, midas_config, paths=paths)
+
+	pool = None
+	if encoding_index != None and worker_count > 1:
+		pool = decode.create_pool(encoding_index, worker_count)
+
+	try:
+		for page in page_cache.iterate_pages(slice_key):
+			decode.write_page(writer, DataFrame(page), encoding_index, worker_count, pool)
+	finally:
+		writer.close()
+		if pool != None:
+			pool.close()
+			pool.join()
+
+	print(f"wrote {writer.row_count} events to {path}")
+	return writer.row_count
@@ -0,0 +1,140 @@
+import json
+from datetime import datetime
+from typing import TypedDict
+import pandas as pd
+from midas.playfab import PlayFabClient, RawRowData
+import src.config as config
+from src.config import MidasConfig
+from src.treecode import EncodingIndex, EncodingHistory
+
+# kusto's bag_merge takes at most this many bags at once
+MAX_BAG_MERGE_COUNT = 64
+
+# always sent so every row can still be matched to the encoding its build used
+REQUIRED_PATHS = ["Version"]
+
+class Selection(TypedDict):
+	paths: list[str]
+	event_names: list[str]
+	key_paths: list[tuple[str, ...]]
+
+# a trie of encoded keys, None marking a subtree that is sent whole
+KeyTree = dict[str, "KeyTree | None"]
+
+def get_path(selector: str) -> str:
+	return selector.strip().strip("/").removesuffix("/*").strip("/")
+
+# codes are stored with the marker in midas.cache, and written into events with one more in front
+def get_encoded_key(stripped_code: str, marker: str) -> str:
+	return marker + marker + stripped_code
+
+# booleans in a packed dictionary only exist inside its one binary string, so that whole string is what gets fetched
+def get_fetched_path(path: str, encoding_index: EncodingIndex) -> str:
+	for array_path in encoding_index["arrays"]:
+		if path.startswith(array_path + "/"):
+			return array_path
+	return path
+
+def get_selection(selectors: list[str], event_names: list[str], midas_config: MidasConfig, history: EncodingHistory) -> Selection:
+	tree_paths = list(config.get_tree_index(midas_config)["leaves"]) + list(config.get_tree_index(midas_config)["dictionaries"])
+
+	paths = list(dict.fromkeys([get_path(selector) for selector in selectors]))
+	for path in paths:
+		assert any(tree_path == path or tree_path.startswith(path + "/") for tree_path in tree_paths), f"{path} isn't a path in the tree"
+
+	# the same key can have a different code in an older encoding, so a path is selected under every code it was sent with
+	key_paths: list[tuple[str, ...]] = []
+	if len(paths) > 0:
+		encoding_indices = [history["current"]] + [encoding_index for _, encoding_index in history["snapshots"]]
+		for path in list(dict.fromkeys(paths + REQUIRED_PATHS)):
+			for encoding_index in encoding_indices:
+				codes = {key: code for code, key in encoding_index["properties"].items()}
+				keys = get_fetched_path(path, encoding_index).split("/")
+				if all(key in codes for key in keys):
+					key_paths.append(tuple(get_encoded_key(codes[key], encoding_index["marker"]) for key in keys))
+
+		key_paths = list(dict.fromkeys(key_paths))
+
+	return {
+		"paths": paths,
+		"event_names": list(dict.fromkeys(event_names)),
+		"key_paths": key_paths,
+	}
+
+# what makes two selections fetch different data, for keying runs and cached pages
+def get_selection_params(selection: Selection | None) -> dict | None:
+	if selection == None:
+		return None
+	return {"paths": sorted(selection["paths"]), "event_names": sorted(selection["event_names"])}
+
+def get_key_tree(key_paths: list[tuple[str, ...]]) -> KeyTree:
+	key_tree: KeyTree = {}
+	for key_path in key_paths:
+		node = key_tree
+		for index, key in enumerate(key_path):
+			if index == len(key_path)-1:
+				node[key] = None
+				break
+			child = node.get(key, {})
+			if child == None:
+				# a shorter path already takes this whole subtree
+				break
+			node[key] = child
+			node = child
+
+	return key_tree
+
+def get_merge_expression(expressions: list[str]) -> str:
+	if len(expressions) == 1:
+		return expressions[0]
+	if len(expressions) <= MAX_BAG_MERGE_COUNT:
+		return "bag_merge(" + ", ".join(expressions) + ")"
+	return get_merge_expression([get_merge_expression(expressions[start:(start+MAX_BAG_MERGE_COUNT)]) for start in range(0, len(expressions), MAX_BAG_MERGE_COUNT)])
+
+# keys missing from an event are left out rather than sent as nulls, so the decoded state looks like the game sent it
+def get_bag_expression(key_tree: KeyTree, source: str) -> str:
+	expressions = []
+	for key, child in key_tree.items():
+		value = f"{source}[{json.dumps(key)}]"
+		if child == None:
+			expressions.append(f"iff(isnull({value}), dynamic({{}}), bag_pack({json.dumps(key)}, {value}))")
+		else:
+			expressions.append(f"iff(isnull({value}), dynamic({{}}), bag_pack({json.dumps(key)}, {get_bag_expression(child, value)}))")
+
+	if len(expressions) == 0:
+		return "dynamic({})"
+	return get_merge_expression(expressions)
+
+def get_projected_query(query: str, selection: Selection) -> str:
+	lines = [query.rstrip()]
+	if len(selection["event_names"]) > 0:
+		lines.append(f"| where EventName in (dynamic({json.dumps(selection['event_names'])}))")
+	if len(selection["key_paths"]) > 0:
+		state = get_bag_expression(get_key_tree(selection["key_paths"]), "EventData.State")
+		lines.append(f"| extend EventData = bag_merge(bag_remove_keys(EventData, dynamic([\"State\"])), bag_pack(\"State\", {state}))")
+
+	return "\n".join(lines) + "\n"
+
+# the library's query points sys.stdout at devnull while it waits, which breaks once pages are fetched from several threads
+class PlayFabQueryClient(PlayFabClient):
+	def query(self, query=""):
+		response = self.client.execute(self.title_id, query)
+		return pd.DataFrame(json.loads(str(response[0]))["data"]).to_dict(orient="records")
+
+# stands in for the client so the library writes its event query without sending it
+class QueryRecorder(PlayFabClient):
+	def __init__(self, title_id: str):
+		self.title_id = title_id
+		self.recorded_query = ""
+
+	def query(self, query=""):
+		self.recorded_query = query
+		return []
+
+def query_selected_events(pf_client: PlayFabClient, playfab_user_ids: list[str], user_join_floor: datetime, selection: Selection | None) -> list[RawRowData]:
+	if selection == None:
+		return pf_client.query_events_from_user_data(playfab_user_ids, user_join_floor)
+
+	recorder = QueryRecorder(pf_client.title_id)
+	recorder.query_events_from_user_data(playfab_user_ids, user_join_floor)
+	return pf_client.query(get_projected_query(recorder.recorded_query, selection))
@@ -0,0 +1,201 @@
+import os
+import copy
+import json
+from typing import TypedDict, Any
+import midas.data_encoder as data_encoder
+import src.config as config
+import src.treecode as treecode
+from src.config import MidasConfig
+
+REPORT_TOP_COUNT = 10
+REPORT_SAMPLE_LIMIT = 200
+
+# stand-in values for a simulated snapshot, sized like what a live server typically sends
+SIMULATED_VALUES: dict[str, Any] = {
+	"integer": 1000,
+	"double": 100.25,
+	"float": 100.123456789,
+	"boolean": True,
+	"string": "0123456789ABCDEF",
+}
+
+class SizeReport(TypedDict):
+	name: str
+	raw_bytes: float
+	encoded_bytes: float
+
+class EncodingReport(TypedDict):
+	is_simulated: bool
+	state_count: int
+	snapshot: SizeReport
+	events: list[SizeReport]
+	contributors: list[SizeReport]
+
+def get_payload_size(data: Any) -> int:
+	# roblox's JSONEncode doesn't add whitespace
+	return len(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+
+def get_simulated_state(tree: dict) -> dict[str, Any]:
+	state = {}
+	for key, value in tree.items():
+		if config.get_if_index_key(key):
+			continue
+		elif isinstance(value, dict):
+			if len(value) > 0:
+				state[key] = get_simulated_state(value)
+		elif type(value) == list:
+			options = [option for option in value if option != "nil"]
+			if len(options) > 0:
+				state[key] = options[0]
+		elif type(value) == str:
+			state[key] = SIMULATED_VALUES.get(value.replace("?", ""), SIMULATED_VALUES["string"])
+
+	return state
+
+def get_template_event_names(event_template: dict, prefix="") -> list[str]:
+	event_names = []
+	for key, value in event_template.items():
+		if isinstance(value, dict):
+			event_names += get_template_event_names(value, prefix + key + "/")
+		elif value != False and value != None:
+			event_names.append(prefix + key)
+
+	return event_names
+
+def get_subtree_paths(state: dict, prefix="") -> list[str]:
+	paths = []
+	for key, value in state.items():
+		if isinstance(value, dict):
+			paths.append(prefix + key)
+			paths += get_subtree_paths(value, prefix + key + "/")
+
+	return paths
+
+def get_without_path(state: dict, path: str) -> dict:
+	keys = path.split("/")
+	trimmed_state = copy.deepcopy(state)
+	parent = trimmed_state
+	for key in keys[:-1]:
+		if not isinstance(parent.get(key, None), dict):
+			return trimmed_state
+		parent = parent[key]
+
+	parent.pop(keys[-1], None)
+	return trimmed_state
+
+def get_average(values: list[int]) -> float:
+	if len(values) == 0:
+		return 0
+	return sum(values) / len(values)
+
+def get_encoding_report(midas_config: MidasConfig, encoding_tree: Any, sample_events: list[tuple[str, Any]] | None=None) -> EncodingReport:
+	is_simulated = sample_events == None or len(sample_events) == 0
+	if is_simulated:
+		state = get_simulated_state(midas_config["tree"])
+		event_names = get_template_event_names(midas_config["template"]["Event"])
+		sample_events = [(event_name, state) for event_name in event_names]
+		if len(sample_events) == 0:
+			sample_events = [("", state)]
+
+	assert sample_events != None
+	sample_events = sample_events[:REPORT_SAMPLE_LIMIT]
+
+	# the state is sent under the event name, so each event's payload is measured with it
+	raw_sizes: list[int] = []
+	encoded_sizes: list[int] = []
+	event_sizes: dict[str, tuple[list[int], list[int]]] = {}
+	for event_name, state in sample_events:
+		raw_size = get_payload_size({"EventName": event_name, "State": state})
+		encoded_size = get_payload_size({"EventName": event_name, "State": data_encoder.encode(state, encoding_tree)})
+		raw_sizes.append(raw_size)
+		encoded_sizes.append(encoded_size)
+
+		if not event_name in event_sizes:
+			event_sizes[event_name] = ([], [])
+		event_sizes[event_name][0].append(raw_size)
+		event_sizes[event_name][1].append(encoded_size)
+
+	# a subtree costs whatever the payload shrinks by once it's removed
+	unique_states = list({id(state): state for _, state in sample_events}.values())
+	contributor_sizes: dict[str, tuple[list[int], list[int]]] = {}
+	for state in unique_states:
+		raw_size = get_payload_size(state)
+		encoded_size = get_payload_size(data_encoder.encode(state, encoding_tree))
+		for path in get_subtree_paths(state):
+			trimmed_state = get_without_path(state, path)
+			if not path in contributor_sizes:
+				contributor_sizes[path] = ([], [])
+			contributor_sizes[path][0].append(raw_size - get_payload_size(trimmed_state))
+			contributor_sizes[path][1].append(encoded_size - get_payload_size(data_encoder.encode(trimmed_state, encoding_tree)))
+
+	events: list[SizeReport] = []
+	for event_name, (event_raw_sizes, event_encoded_sizes) in event_sizes.items():
+		events.append({
+			"name": event_name,
+			"raw_bytes": get_average(event_raw_sizes),
+			"encoded_bytes": get_average(event_encoded_sizes),
+		})
+	events.sort(key=lambda size_report: size_report["encoded_bytes"], reverse=True)
+
+	contributors: list[SizeReport] = []
+	for path, (path_raw_sizes, path_encoded_sizes) in contributor_sizes.items():
+		contributors.append({
+			"name": path,
+			"raw_bytes": get_average(path_raw_sizes),
+			"encoded_bytes": get_average(path_encoded_sizes),
+		})
+	contributors.sort(key=lambda size_report: size_report["encoded_bytes"], reverse=True)
+
+	return {
+		"is_simulated": is_simulated,
+		"state_count": len(sample_events),
+		"snapshot": {
+			"name": "State",
+			"raw_bytes": get_average(raw_sizes),
+			"encoded_bytes": get_average(encoded_sizes),
+		},
+		"events": events,
+		"contributors": contributors,
+	}
+
+def get_size_text(size_report: SizeReport, total_bytes: float | None=None) -> str:
+	ratio = 0
+	if size_report["raw_bytes"] > 0:
+		ratio = round(100*size_report["encoded_bytes"]/size_report["raw_bytes"])
+	text = f"{round(size_report['encoded_bytes'])} bytes encoded, {round(size_report['raw_bytes'])} as json ({ratio}%)"
+
+	if total_bytes != None and total_bytes > 0:
+		text += f", {round(100*size_report['encoded_bytes']/total_bytes)}% of the payload"
+	return text
+
+def print_encoding_report(encoding_report: EncodingReport, top_count=REPORT_TOP_COUNT):
+	snapshot = encoding_report["snapshot"]
+	total_bytes = snapshot["encoded_bytes"]
+
+	if encoding_report["is_simulated"]:
+		print("simulated from the tree in midas.yaml with typical values\n")
+	else:
+		print(f"averaged over {encoding_report['state_count']} sampled events\n")
+
+	print(f"payload: {get_size_text(snapshot)}")
+	print(f"saved by encoding: {round(snapshot['raw_bytes'] - snapshot['encoded_bytes'])} bytes per event\n")
+
+	print("events")
+	for size_report in encoding_report["events"]:
+		print(f"\t{size_report['name'] or '(unnamed)'}: {get_size_text(size_report)}")
+
+	print("\nlargest subtrees")
+	for i, size_report in enumerate(encoding_report["contributors"][:top_count]):
+		print(f"\t{i+1}. {size_report['name']}: {get_size_text(size_report, total_bytes)}")
+
+def main(midas_config: MidasConfig | None=None, sample_path: str | None=None, top_count=REPORT_TOP_COUNT):
+	if midas_config == None:
+		midas_config = config.get_midas_config()
+
+	assert os.path.exists(treecode.TREE_ENCODING_PATH), f"{treecode.TREE_ENCODING_PATH} doesn't exist yet, run midas build first"
+
+	sample_events = None
+	if sample_path != None:
+		sample_events = treecode.get_sample_events(sample_path)
+
+	print_encoding_report(get_encoding_report(midas_config, treecode.get_tree_encoding(), sample_events), top_count)
@@ -0,0 +1,347 @@
+import os
+import time
+import bisect
+import random
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+from typing import Iterator, TypedDict
+from azure.kusto.data.exceptions import KustoThrottlingError
+from pandas import DataFrame
+import src.decode as decode
+import src.export as export
+import src.watermark as watermark
+import src.pagecache as pagecache
+import src.projection as projection
+from src.watermark import WatermarkStore
+from src.pagecache import PageCache
+from src.projection import Selection
+from src.treecode import EncodingIndex, EncodingHistory
+from src.config import MidasConfig
+from src.export import OutputFormat
+from midas.playfab import PlayFabClient, UserData, RawRowData, update_based_on_success
+
+MAX_EVENT_LIST_LENGTH = 20000
+EVENT_UPDATE_INCREMENT = 2500
+FAIL_DELAY = 5
+DELAY_UPDATE_INCREMENT = 5
+DEFAULT_CONCURRENCY = 4
+MAX_THROTTLE_DELAY = 120
+
+class PageRequest(TypedDict):
+	start_index: int
+	user_data_list: list[UserData]
+	attempt: int
+	ready_at: float
+
+def get_user_batch(user_data_list: list[UserData], event_limit: int, start_index=0) -> list[UserData]:
+	batch: list[UserData] = []
+	event_count = 0
+
+	for user_data in user_data_list[start_index:]:
+		if event_count + user_data["EventCount"] >= event_limit and len(batch) > 0:
+			break
+		event_count += user_data["EventCount"]
+		batch.append(user_data)
+
+	return batch
+
+def get_batch_floor(user_ids: list[str], user_join_floor: datetime, user_watermarks: dict[str, datetime]) -> datetime:
+	# only users that have all been downloaded before can raise the floor past the join date
+	floors = []
+	for user_id in user_ids:
+		if not user_id in user_watermarks:
+			return user_join_floor
+		floors.append(user_watermarks[user_id])
+
+	if len(floors) == 0:
+		return user_join_floor
+
+	# playfab queries are written without a timezone, so pass the floor as naive utc
+	floor = min(floors).astimezone(timezone.utc).replace(tzinfo=None)
+	return max(floor, user_join_floor.replace(tzinfo=None))
+
+def split_request(request: PageRequest, event_limit: int) -> list[PageRequest]:
+	requests: list[PageRequest] = []
+	start_index = 0
+	while start_index < len(request["user_data_list"]):
+		batch = get_user_batch(request["user_data_list"], event_limit, start_index)
+		requests.append({
+			"start_index": request["start_index"] + start_index,
+			"user_data_list": batch,
+			"attempt": request["attempt"],
+			"ready_at": request["ready_at"],
+		})
+		start_index += len(batch)
+
+	return requests
+
+def get_event_count(user_data_list: list[UserData]) -> int:
+	event_count = 0
+	for user_data in user_data_list:
+		event_count += user_data["EventCount"]
+	return event_count
+
+def truncate_file(path: str, size: int):
+	with open(path, "rb+") as out_file:
+		out_file.truncate(size)
+
+def query_user_data_list(pf_client: PlayFabClient, user_join_floor: datetime, join_window_in_days: int, user_limit: int) -> list[UserData]:
+	user_data_list = pf_client.query_user_data_list(user_join_floor, join_window_in_days, user_limit)
+	print(f"{len(user_data_list)} users joined in the {join_window_in_days} day window after {user_join_floor}\n")
+	return user_data_list
+
+def iterate_event_pages(
+	pf_client: PlayFabClient,
+	user_join_floor: datetime,
+	join_window_in_days: int,
+	user_limit: int,
+	max_event_list_length=MAX_EVENT_LIST_LENGTH,
+	update_increment=EVENT_UPDATE_INCREMENT,
+	skip_user_ids: set[str] | None=None,
+	user_watermarks: dict[str, datetime] | None=None,
+	concurrency=DEFAULT_CONCURRENCY,
+	selection: Selection | None=None,
+	user_data_list: list[UserData] | None=None
+) -> Iterator[tuple[list[str], list[RawRowData]]]:
+	if skip_user_ids == None:
+		skip_user_ids = set()
+	if user_watermarks == None:
+		user_watermarks = {}
+
+	if user_data_list == None:
+		user_data_list = query_user_data_list(pf_client, user_join_floor, join_window_in_days, user_limit)
+
+	if len(skip_user_ids) > 0:
+		user_data_list = [user_data for user_data in user_data_list if not user_data["PlayFabUserId"] in skip_user_ids]
+		print(f"skipping {len(skip_user_ids)} users that were already downloaded")
+
+	total_event_count = get_event_count(user_data_list)
+
+	def fetch_page(request: PageRequest) -> list[RawRowData]:
+		batch_user_ids = [user_data["PlayFabUserId"] for user_data in request["user_data_list"]]
+		events_after = get_batch_floor(batch_user_ids, user_join_floor, user_watermarks)
+		return projection.query_selected_events(pf_client, batch_user_ids, events_after, selection)
+
+	event_limit = max_event_list_length
+	fail_delay = FAIL_DELAY
+	completed_events = 0
+
+	# halved whenever the server throttles, then grows back by one per success
+	request_limit = max(1, concurrency)
+
+	# users before planned_index are in a request, users before yielded_index have been yielded
+	planned_index = 0
+	yielded_index = 0
+
+	retry_requests: list[PageRequest] = []
+	running_requests: dict[Future, PageRequest] = {}
+	finished_pages: dict[int, tuple[PageRequest, list[RawRowData]]] = {}
+
+	with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+		while yielded_index < len(user_data_list):
+			now = time.time()
+
+			# finished pages are held until every earlier page arrives, so cap how far ahead requests can run
+			while len(running_requests) < request_limit and len(running_requests) + len(finished_pages) < 2*max(1, concurrency):
+				request: PageRequest
+				if len(retry_requests) > 0:
+					if retry_requests[0]["ready_at"] > now:
+						break
+					request = retry_requests.pop(0)
+				elif planned_index < len(user_data_list):
+					batch = get_user_batch(user_data_list, event_limit, planned_index)
+					request = {"start_index": planned_index, "user_data_list": batch, "attempt": 0, "ready_at": now}
+					planned_index += len(batch)
+				else:
+					break
+
+				print(f"downloading {get_event_count(request['user_data_list'])} events for users {request['start_index']+1} -> {request['start_index']+len(request['user_data_list'])}")
+				running_requests[executor.submit(fetch_page, request)] = request
+
+			timeout = None
+			if len(retry_requests) > 0:
+				timeout = max(0, retry_requests[0]["ready_at"] - time.time())
+
+			if len(running_requests) == 0:
+				time.sleep(timeout or 0)
+				continue
+
+			done, _ = wait(running_requests, timeout=timeout, return_when=FIRST_COMPLETED)
+			for future in done:
+				request = running_requests.pop(future)
+				try:
+					page = future.result()
+				except Exception as error:
+					failed_requests: list[PageRequest]
+					if isinstance(error, KustoThrottlingError):
+						# throttling isn't about the page size, so retry the same users with fewer requests at once
+						request_limit = max(1, request_limit // 2)
+						delay = min(MAX_THROTTLE_DELAY, FAIL_DELAY * 2**request["attempt"]) * random.uniform(0.5, 1)
+						print(f"throttled, waiting {round(delay, 1)}s with {request_limit} requests at once")
+						failed_requests = [request]
+					else:
+						print("failed")
+						event_limit, fail_delay = update_based_on_success(False, event_limit, fail_delay, max_event_list_length, update_increment, DELAY_UPDATE_INCREMENT)
+						delay = fail_delay
+						print("waiting ", fail_delay)
+						print("re-attempting with an event limit of: ", event_limit)
+						failed_requests = split_request(request, event_limit)
+
+					for failed_request in failed_requests:
+						failed_request["attempt"] += 1
+						failed_request["ready_at"] = time.time() + delay
+						bisect.insort(retry_requests, failed_request, key=lambda retry_request: retry_request["start_index"])
+					continue
+
+				event_limit, fail_delay = update_based_on_success(True, event_limit, fail_delay, max_event_list_length, update_increment, DELAY_UPDATE_INCREMENT)
+				request_limit = min(max(1, concurrency), request_limit+1)
+				finished_pages[request["start_index"]] = (request, page)
+
+			# pages are yielded in user order whatever order they finished in, so the output doesn't depend on timing
+			while yielded_index in finished_pages:
+				request, page = finished_pages.pop(yielded_index)
+				yielded_index += len(request["user_data_list"])
+				completed_events += get_event_count(request["user_data_list"])
+
+				if total_event_count > 0:
+					print(f"{round(1000*completed_events/total_event_count)/10}% complete.\n")
+
+				yield [user_data["PlayFabUserId"] for user_data in request["user_data_list"]], page
+
+def download_to_file(
+	pf_client: PlayFabClient,
+	path: str,
+	user_join_floor: datetime,
+	join_window_in_days: int,
+	user_limit: int,
+	encoding_index: EncodingIndex | EncodingHistory | None,
+	worker_count=decode.DEFAULT_WORKER_COUNT,
+	output_format: OutputFormat=export.DEFAULT_OUTPUT_FORMAT,
+	midas_config: MidasConfig | None=None,
+	store: WatermarkStore | None=None,
+	is_resume=False,
+	is_since_last=False,
+	concurrency=DEFAULT_CONCURRENCY,
+	page_cache: PageCache | None=None,
+	selection: Selection | None=None
+) -> int:
+	title_id = pf_client.title_id
+	run_params = {
+		"title_id": title_id,
+		"path": os.path.abspath(path),
+		"user_join_floor": user_join_floor,
+		"join_window_in_days": join_window_in_days,
+		"user_limit": user_limit,
+		"is_raw": encoding_index == None,
+		"output_format": output_format,
+		"is_since_last": is_since_last,
+	}
+
+	# only added when there is one, so interrupted unfiltered downloads still resume
+	if selection != None:
+		run_params["selection"] = projection.get_selection_params(selection)
+	run_key = watermark.get_run_key(**run_params)
+
+	skip_user_ids: set[str] = set()
+	user_watermarks: dict[str, datetime] = {}
+	user_data_list: list[UserData] | None = None
+	is_append = False
+
+	if store != None:
+		# columnar files only store their progress once complete, so an interrupted one has nothing to resume from
+		if is_resume and not output_format in export.APPENDABLE_FORMATS:
+			print(f"only {', '.join(export.APPENDABLE_FORMATS)} downloads can be resumed, starting a new one")
+		elif is_resume and store.get_if_run_incomplete(run_key):
+			user_data_list = store.get_run_user_data_list(run_key)
+			committed_size = store.get_run_out_size(run_key)
+
+			# runs from before the user list was kept have nothing to resume from
+			if len(user_data_list) == 0:
+				user_data_list = None
+				print("no interrupted download found, starting a new one")
+
+			# the completed users are skipped, so the file has to still hold every page they were written in
+			elif committed_size > 0 and (not os.path.exists(path) or os.path.getsize(path) < committed_size):
+				user_data_list = None
+				print(f"{path} no longer holds what the interrupted download wrote, starting a new one")
+
+			# a page written after the last commit is dropped, since its users are fetched again
+			elif os.path.exists(path):
+				truncate_file(path, committed_size)
+		elif is_resume:
+			print("no interrupted download found, starting a new one")
+
+		if user_data_list != None:
+			skip_user_ids = store.get_completed_user_ids(run_key)
+			is_append = True
+			print(f"resuming interrupted download to {path} with its {len(user_data_list)} users")
+		else:
+			user_data_list = query_user_data_list(pf_client, user_join_floor, join_window_in_days, user_limit)
+			store.start_run(run_key, title_id, os.path.abspath(path), user_data_list)
+
+		if is_since_last:
+			user_watermarks = store.get_user_watermarks(title_id)
+			print(f"only downloading events newer than the last download for {len(user_watermarks)} known users")
+
+	writer = export.get_writer(os.path.abspath(path), output_format, midas_config, append=is_append, paths=selection["paths"] if selection != None else None)
+
+	# columnar files aren't readable until closed, so their progress is only stored once the file is complete
+	pending_pages: list[tuple[list[str], dict[str, str]]] = []
+
+	# reuse one pool across pages rather than paying process startup per page
+	pool = None
+	if encoding_index != None and worker_count > 1:
+		pool = decode.create_pool(encoding_index, worker_count)
+
+	pages = iterate_event_pages(
+		pf_client,
+		user_join_floor,
+		join_window_in_days,
+		user_limit,
+		skip_user_ids=skip_user_ids,
+		user_watermarks=user_watermarks,
+		concurrency=concurrency,
+		selection=selection,
+		user_data_list=user_data_list
+	)
+	if page_cache != None:
+		slice_key = None
+		if is_append and store != None:
+			# the watermarks have moved on since the run started, so its slice is looked up rather than keyed again
+			slice_key = store.get_run_slice_key(run_key)
+			if slice_key == None:
+				print("the interrupted download wasn't cached, so the rest of it won't be either")
+		else:
+			slice_key = pagecache.get_slice_key(title_id, user_join_floor, join_window_in_days, user_limit, user_watermarks, selection)
+			if store != None:
+				store.set_run_slice_key(run_key, slice_key)
+
+		if slice_key != None:
+			page_cache.start_slice(slice_key, title_id, user_join_floor, join_window_in_days, user_limit, is_append)
+			pages = pagecache.iterate_cached_pages(pages, page_cache, slice_key)
+
+	try:
+		for user_ids, page in pages:
+			df = watermark.filter_page(DataFrame(page), user_watermarks)
+			page_watermarks = watermark.get_page_watermarks(df)
+
+			decode.write_page(writer, df, encoding_index, worker_count, pool)
+
+			if store != None:
+				if output_format in export.APPENDABLE_FORMATS:
+					store.complete_page(run_key, title_id, user_ids, page_watermarks, os.path.getsize(path))
+				else:
+					pending_pages.append((user_ids, page_watermarks))
+	finally:
+		writer.close()
+		if pool != None:
+			pool.close()
+			pool.join()
+
+	if store != None:
+		for user_ids, page_watermarks in pending_pages:
+			store.complete_page(run_key, title_id, user_ids, page_watermarks)
+		store.finish_run(run_key)
+
+	print(f"\nwrote {writer.row_count} events to {path}")
+	return writer.row_count
@@ -0,0 +1,139 @@
+import copy
+import json
+import random
+import yaml
+from datetime import datetime, timedelta
+from typing import Any
+import midas.data_encoder as data_encoder
+import src.config as config
+from src.config import MidasConfig
+
+LEAVES_PER_GROUP = 10
+GROUPS_PER_SECTION = 10
+OPTIONS_PER_LEAF = 4
+SYNTHETIC_EVENT_NAMES = ["Interval", "Interval", "Interval", "Spoke", "Died", "Purchase"]
+SYNTHETIC_EVENT_INTERVAL = 15
+SYNTHETIC_START = datetime(2023, 6, 25, 18, 37, 11)
+EVENT_DATA_POOL_SIZE = 1000
+
+# a tree of leaf_count leaves with the same mix of value types, option lists and boolean dictionaries that real trees use
+def get_synthetic_tree(leaf_count: int) -> dict[str, Any]:
+	tree: dict[str, Any] = {}
+	for index in range(leaf_count):
+		group_index = index // LEAVES_PER_GROUP
+		section_name = f"Section{group_index // GROUPS_PER_SECTION}"
+		group_name = f"Group{group_index}"
+		if not section_name in tree:
+			tree[section_name] = {}
+		if not group_name in tree[section_name]:
+			tree[section_name][group_name] = {}
+
+		leaf_type: Any
+		if group_index % 5 == 4:
+			leaf_type = "boolean"
+		elif index % 5 == 0:
+			leaf_type = [f"Option{index}x{option_index}" for option_index in range(OPTIONS_PER_LEAF)]
+		else:
+			leaf_type = ["integer", "double", "string", "boolean"][index % 4]
+
+		tree[section_name][group_name][f"Leaf{index}"] = leaf_type
+
+	return tree
+
+# written out and loaded back so the template values are added to the tree like they are for a real project
+def get_synthetic_config(leaf_count: int, config_path=config.CONFIG_TOML_PATH) -> MidasConfig:
+	untyped_config: Any = copy.deepcopy(config.DEFAULT_CONFIG_TEMPLATE)
+	untyped_config["tree"].update(get_synthetic_tree(leaf_count))
+
+	config_file = open(config_path, "w")
+	config_file.write(yaml.safe_dump(untyped_config))
+	config_file.close()
+
+	return config.load_midas_config(config_path)
+
+def get_synthetic_value(value_type: Any, rng: random.Random) -> Any:
+	if type(value_type) == list:
+		options = [option for option in value_type if option != "nil"]
+		return rng.choice(options) if len(options) > 0 else None
+
+	value_type = value_type.replace("?", "")
+	if value_type == "integer":
+		return rng.randint(0, 10000)
+	elif value_type == "double":
+		return round(rng.uniform(0, 1000), 2)
+	elif value_type == "float":
+		return rng.uniform(0, 1000)
+	elif value_type == "boolean":
+		return rng.random() > 0.5
+	return "%016x" % rng.getrandbits(64)
+
+def get_synthetic_state(tree: dict[str, Any], rng: random.Random) -> dict[str, Any]:
+	state = {}
+	for key, value in tree.items():
+		if config.get_if_index_key(key):
+			continue
+		elif isinstance(value, dict):
+			if len(value) > 0:
+				state[key] = get_synthetic_state(value, rng)
+		elif type(value) == list or type(value) == str:
+			synthetic_value = get_synthetic_value(value, rng)
+			if synthetic_value != None:
+				state[key] = synthetic_value
+
+	return state
+
+def get_synthetic_user_ids(user_count: int, seed=0) -> list[str]:
+	rng = random.Random(seed)
+	return ["%016X" % rng.getrandbits(64) for _ in range(user_count)]
+
+# (event name, EventData json) pairs, encoding is the slow part so events are drawn from a pool rather than encoded one by one
+def get_synthetic_event_data_pool(midas_config: MidasConfig, encoding_tree: Any, pool_size=EVENT_DATA_POOL_SIZE, seed=0) -> list[tuple[str, str]]:
+	rng = random.Random(seed)
+	event_data_pool = []
+	for _ in range(pool_size):
+		event_name = rng.choice(SYNTHETIC_EVENT_NAMES)
+		event_data = {
+			"EventName": event_name,
+			"EventNamespace": "custom.midas",
+			"State": data_encoder.encode(get_synthetic_state(midas_config["tree"], rng), encoding_tree),
+		}
+		event_data_pool.append((event_name, json.dumps(event_data)))
+
+	return event_data_pool
+
+# raw rows shaped like PlayFabClient.query_events_from_user_data results
+def get_synthetic_user_events(user_id: str, event_count: int, session_start: datetime, event_data_pool: list[tuple[str, str]], seed=0) -> list[dict[str, Any]]:
+	rng = random.Random(f"{seed}/{user_id}")
+	session_id = "%016X" % rng.getrandbits(64)
+
+	events = []
+	for event_index in range(event_count):
+		event_name, event_data = event_data_pool[rng.randrange(len(event_data_pool))]
+		time = event_index * SYNTHETIC_EVENT_INTERVAL
+		events.append({
+			"EventData": event_data,
+			"Timestamp": (session_start + timedelta(seconds=time)).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+			"PlayFabUserId": user_id,
+			"EventName": event_name,
+			"EventId": "%032x" % rng.getrandbits(128),
+			"SessionId": session_id,
+			"Time": float(time),
+		})
+
+	return events
+
+def get_synthetic_events(
+	midas_config: MidasConfig,
+	encoding_tree: Any,
+	user_ids: list[str],
+	events_per_user: int,
+	seed=0,
+	start=SYNTHETIC_START
+) -> list[dict[str, Any]]:
+	event_data_pool = get_synthetic_event_data_pool(midas_config, encoding_tree, seed=seed)
+
+	events = []
+	for user_index, user_id in enumerate(user_ids):
+		events += get_synthetic_user_events(user_id, events_per_user, start + timedelta(seconds=user_index), event_data_pool, seed)
+
+	return events
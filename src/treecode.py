@@ -1,17 +1,24 @@
 
+import re
 import copy
-import math
+import functools
+import hashlib
 import json
+import pickle
 import dpath
 import os
 import src.config as config
-from src.config import TrackerType
+from src.config import TrackerType, MidasConfig
 from typing import TypedDict, Literal, Union, Any
 
 ENCODING_MARKER = config.ENCODING_MARKER
 TREE_ENCODING_PATH = "midas.cache"
+TREE_ENCODING_INDEX_PATH = "midas.cache.index"
+TREE_ENCODING_SNAPSHOT_PATH = "midas.cache.versions"
+ENCODING_INDEX_VERSION = 1
 ASCII_FLOOR = 33
 ASCII_CEILING = 91
+SNAPSHOT_NAME_PATTERN = re.compile(r"(\d+)\.(\d+)\.(\d+)-([0-9a-f]+)\.json")
 BAD_ASCII_CHARACTERS = [":", "\"", "\\", "%", "'", "`", "*", ".", "$", "^", "(", ")", "[", "]", "+", "-", "?"]
 
 class EncodingDictionary(TypedDict):
@@ -24,7 +31,24 @@ class EncodingTree(TypedDict):
 	dictionary: EncodingDictionary
 	arrays: dict
 
-def get_code(index: int, marker: str) -> str:
+# reverse lookups compiled from midas.cache, codes are stored with the marker stripped
+class EncodingIndex(TypedDict):
+	version: int
+	source_hash: str
+	marker: str
+	properties: dict[str, str]
+	values: dict[str, dict[str, str]]
+	arrays: dict[str, tuple[str, ...]]
+
+BuildVersion = tuple[int, int, int]
+
+# the current index, and the one each earlier build was sent with ordered by version, the latest encoding of a version winning
+class EncodingHistory(TypedDict):
+	current: EncodingIndex
+	snapshots: list[tuple[BuildVersion, EncodingIndex]]
+
+@functools.lru_cache(maxsize=None)
+def get_code_alphabet(marker: str) -> tuple[str, ...]:
 	ascii_codes = []
 
 	for i in range(ASCII_FLOOR, ASCII_CEILING):
@@ -33,41 +57,85 @@ def get_code(index: int, marker: str) -> str:
 		if not char in BAD_ASCII_CHARACTERS and char != marker:
 			ascii_codes.append(char)
 
-	code_count = len(ascii_codes)
-	max_val = code_count-1
+	return tuple(ascii_codes)
+
+@functools.lru_cache(maxsize=None)
+def get_code_lookup(marker: str) -> dict[str, int]:
+	return {char: i for i, char in enumerate(get_code_alphabet(marker))}
+
+def get_code(index: int, marker: str) -> str:
+	ascii_codes = get_code_alphabet(marker)
+
+	# the final character is only ever used on its own, every longer code counts in base len-1
+	base = len(ascii_codes)-1
 
-	def read_char(index: int) -> str:
-		return ascii_codes[index]
+	if index <= base:
+		return marker+ascii_codes[index]
 
-	def get_char(relative_index: int, code=f"") -> str:
-		unrounded_exponent = math.log(relative_index, max_val)
-		exponent = math.floor(unrounded_exponent)
+	code = ""
+	while index > 0:
+		index, digit = divmod(index, base)
+		code = ascii_codes[digit] + code
 
-		if unrounded_exponent <= 1:
+	return marker+code
 
-			return code + read_char(relative_index)
-		else:
+def decode_code(code: str, marker: str) -> int:
+	lookup = get_code_lookup(marker)
+	base = len(lookup)-1
 
-			increment = math.pow(max_val, exponent)
-			leading_value = math.floor(relative_index/increment)
-			foundation = leading_value*increment
-			remainder = int(relative_index-foundation)
-			code += read_char(leading_value)
+	if code.startswith(marker):
+		code = code[len(marker):]
 
-			if remainder == 0:
+	assert len(code) > 0, "code is empty"
 
-				for i in range(0, exponent):
-					code += read_char(0)
-				return code
-			else:	
+	if len(code) == 1:
+		return lookup[code]
 
-				return get_char(remainder, code)
+	index = 0
+	for char in code:
+		index = index*base + lookup[char]
 
-	return marker+get_char(index)
+	return index
 
-def set_tree_encoding():
-	midas_config = config.get_midas_config()
-	tree_structure = midas_config["tree"]
+# (event name, state) pairs from a decoded json / ndjson download
+def get_sample_events(sample_path: str) -> list[tuple[str, Any]]:
+	sample_file = open(sample_path, "r")
+	if sample_path.endswith(".ndjson"):
+		records = [json.loads(line) for line in sample_file if line.strip() != ""]
+	else:
+		records = json.loads(sample_file.read())
+	sample_file.close()
+
+	events = []
+	for record in records:
+		event_data = record.get("EventData", None)
+		if type(event_data) == str:
+			event_data = json.loads(event_data)
+		if isinstance(event_data, dict) and isinstance(event_data.get("State", None), dict):
+			events.append((str(record.get("EventName", "")), event_data["State"]))
+
+	return events
+
+# counts how often each key and string value is sent within a decoded json / ndjson download
+def get_pattern_frequencies(sample_path: str) -> dict[str, int]:
+	pattern_frequencies: dict[str, int] = {}
+
+	def count_state(state: dict):
+		for key, value in state.items():
+			pattern_frequencies[key] = pattern_frequencies.get(key, 0) + 1
+			if isinstance(value, dict):
+				count_state(value)
+			elif type(value) == str:
+				pattern_frequencies[value] = pattern_frequencies.get(value, 0) + 1
+
+	for _, state in get_sample_events(sample_path):
+		count_state(state)
+
+	return pattern_frequencies
+
+def set_tree_encoding(midas_config: MidasConfig | None = None, pattern_frequencies: dict[str, int] | None = None):
+	if midas_config == None:
+		midas_config = config.get_midas_config()
 
 	# read prior tree
 	old_patterns: list[str] = []
@@ -81,6 +149,9 @@ def set_tree_encoding():
 			if type(value) == list:
 				old_binary_paths[path] = copy.deepcopy(value)
 
+	# membership is checked for every key and option, so a list would make re-encoding large trees quadratic
+	old_pattern_set = set(old_patterns)
+
 	# list of paths with an encodable property at the end
 	property_paths = []
 
@@ -94,58 +165,47 @@ def set_tree_encoding():
 	binary_arrays: dict[str, list[str]] = {}
 
 	# read tree to fill in above values
-	for path, value in dpath.search(tree_structure, '**', yielded=True):
-		# filter out list paths
-		path_keys = path.split("/")
-		is_num = False
-		for key in path_keys:
-			final_key = path_keys[len(path_keys)-1]
-			try:
-				int(final_key)
-				is_num = True
-			except:
-				is_num = False
-
-		# add pattern
-		if not is_num and  type(value) == str or type(value) == list:
-			property_paths.append(path)
+	tree_index = config.get_tree_index(midas_config)
 
-			if type(value) == list:
-				value_variants[path] = []
-				for v in value:
-					if not v in old_patterns:
-						new_patterns.append(v)
-					value_variants[path].append(v)
-
-		elif type(value) == dict:
-			property_paths.append(path)
-			is_all_boolean = True
-			for k, v in value.items():
-				if v != "boolean":
-					is_all_boolean = False
-			
-			if is_all_boolean:
-				current_values = list(value.keys())
-				if path in old_binary_paths:
-					for i, v in enumerate(current_values):
-						if len(old_binary_paths[path])-1 >= i:
-							old_v = old_binary_paths[path][i]
-							assert old_v == v, f"binary sequence is desynced at entry {i} at {path}"		
-
-					assert len(current_values) >= len(old_binary_paths[path]), f"new binary sequence at {path} is shorter, don't do this"
-
-				binary_arrays[path] = current_values
+	for path, leaf in tree_index["leaves"].items():
+		property_paths.append(path)
+
+		if leaf["options"] != None:
+			value_variants[path] = []
+			for v in leaf["options"]:
+				if not v in old_pattern_set:
+					new_patterns.append(v)
+				value_variants[path].append(v)
+
+	for path in tree_index["dictionaries"]:
+		property_paths.append(path)
+
+	for path, current_values in tree_index["boolean_arrays"].items():
+		if path in old_binary_paths:
+			for i, v in enumerate(current_values):
+				if len(old_binary_paths[path])-1 >= i:
+					old_v = old_binary_paths[path][i]
+					assert old_v == v, f"binary sequence is desynced at entry {i} at {path}"		
+
+			assert len(current_values) >= len(old_binary_paths[path]), f"new binary sequence at {path} is shorter, don't do this"
+
+		binary_arrays[path] = current_values
 
 	keys: list[str] = []
 
 	for path in property_paths:
 		for key in path.split("/"):
 			keys.append(key)
-			if not key in old_patterns:
+			if not key in old_pattern_set:
 				new_patterns.append(key)
 
-	keys = list(set(keys))
-	new_patterns = list(set(new_patterns))
+	keys = list(dict.fromkeys(keys))
+	new_patterns = list(dict.fromkeys(new_patterns))
+
+	# only new patterns can be ordered, existing codes have to stay put so older data still decodes
+	if pattern_frequencies != None:
+		new_patterns.sort(key=lambda pattern: pattern_frequencies.get(pattern, 0), reverse=True)
+
 	patterns = copy.deepcopy(old_patterns)
 	for new_pattern in new_patterns:
 		patterns.append(new_pattern)
@@ -185,11 +245,166 @@ def set_tree_encoding():
 	}
 	# print("encoding_tree", json.dumps(encoding_tree,indent=5))
 
+	encoding_text = json.dumps(encoding_tree, indent=4)
+
+	save_encoding_snapshot(encoding_text, midas_config["version"])
+
+	# leave an unchanged cache untouched so file watchers aren't triggered
+	if os.path.exists(TREE_ENCODING_PATH) and open(TREE_ENCODING_PATH, "r").read() == encoding_text:
+		return
+
 	encoding_file = open(TREE_ENCODING_PATH, "w")
-	encoding_file.write(json.dumps(encoding_tree, indent=4))
+	encoding_file.write(encoding_text)
 	encoding_file.close()
 
+def get_build_version(version_config: Any) -> BuildVersion:
+	return (int(version_config["major"]), int(version_config["minor"]), int(version_config["patch"]))
+
+# a copy of the encoding each build version was sent with, so its events still decode if midas.cache is ever rewritten
+def save_encoding_snapshot(encoding_text: str, version_config: Any) -> str:
+	major, minor, patch = get_build_version(version_config)
+	source_hash = hashlib.sha1(encoding_text.encode("utf-8")).hexdigest()
+
+	snapshot_path = os.path.join(TREE_ENCODING_SNAPSHOT_PATH, f"{major}.{minor}.{patch}-{source_hash[:12]}.json")
+	if not os.path.exists(snapshot_path):
+		os.makedirs(TREE_ENCODING_SNAPSHOT_PATH, exist_ok=True)
+		snapshot_file = open(snapshot_path, "w")
+		snapshot_file.write(encoding_text)
+		snapshot_file.close()
+
+	return snapshot_path
+
 def get_tree_encoding() -> dict:
 	encoding_file = open(TREE_ENCODING_PATH, "r")
 	config = json.loads(encoding_file.read())
 	return config
+
+def get_value_lookup(options: dict[str, str], marker: str) -> dict[str, str]:
+	lookup: dict[str, str] = {}
+	for code in options.values():
+		stripped_code = code.replace(marker, "")
+		if stripped_code in lookup:
+			continue
+
+		# the decoder keeps comparing after a match, so a later option can replace an earlier one
+		value = stripped_code
+		for option, option_code in options.items():
+			if value == option_code.replace(marker, ""):
+				lookup[stripped_code] = option
+				value = option.replace(marker, "")
+
+	return lookup
+
+def compile_encoding_index(encoding_tree: Any, source_hash: str) -> EncodingIndex:
+	marker = encoding_tree["marker"]
+
+	properties: dict[str, str] = {}
+	for key, code in encoding_tree["dictionary"]["properties"].items():
+		stripped_code = code.replace(marker, "")
+		if not stripped_code in properties:
+			properties[stripped_code] = key
+
+	values: dict[str, dict[str, str]] = {}
+	def add_values(node: dict, prefix: str):
+		for key, value in node.items():
+			if not isinstance(value, dict):
+				continue
+			if len(value) > 0 and all(isinstance(code, str) for code in value.values()):
+				values[prefix + key] = get_value_lookup(value, marker)
+			else:
+				add_values(value, prefix + key + "/")
+
+	add_values(encoding_tree["dictionary"]["values"], "")
+
+	arrays: dict[str, tuple[str, ...]] = {}
+	def add_arrays(node: dict, prefix: str):
+		for key, value in node.items():
+			if type(value) == list:
+				arrays[prefix + key] = tuple(value)
+			elif isinstance(value, dict):
+				add_arrays(value, prefix + key + "/")
+
+	add_arrays(encoding_tree["arrays"], "")
+
+	return {
+		"version": ENCODING_INDEX_VERSION,
+		"source_hash": source_hash,
+		"marker": marker,
+		"properties": properties,
+		"values": values,
+		"arrays": arrays,
+	}
+
+# compiled indices by the hash of the midas.cache they were built from
+_encoding_index_cache: dict[str, EncodingIndex] = {}
+
+def load_encoding_index(encoding_bytes: bytes) -> EncodingIndex:
+	source_hash = hashlib.sha1(encoding_bytes).hexdigest()
+	if not source_hash in _encoding_index_cache:
+		_encoding_index_cache[source_hash] = compile_encoding_index(json.loads(encoding_bytes), source_hash)
+	return _encoding_index_cache[source_hash]
+
+def get_encoding_index() -> EncodingIndex:
+	encoding_bytes = open(TREE_ENCODING_PATH, "rb").read()
+	source_hash = hashlib.sha1(encoding_bytes).hexdigest()
+
+	if source_hash in _encoding_index_cache:
+		return _encoding_index_cache[source_hash]
+
+	encoding_index: EncodingIndex | None = None
+	if os.path.exists(TREE_ENCODING_INDEX_PATH):
+		try:
+			with open(TREE_ENCODING_INDEX_PATH, "rb") as index_file:
+				encoding_index = pickle.load(index_file)
+		except Exception:
+			encoding_index = None
+
+	# the sidecar is rebuilt whenever midas.cache no longer matches the one it was compiled from
+	if encoding_index == None or encoding_index.get("version") != ENCODING_INDEX_VERSION or encoding_index.get("source_hash") != source_hash:
+		encoding_index = compile_encoding_index(json.loads(encoding_bytes), source_hash)
+
+		is_new = not os.path.exists(TREE_ENCODING_INDEX_PATH)
+		temp_path = TREE_ENCODING_INDEX_PATH + f".{os.getpid()}.tmp"
+		with open(temp_path, "wb") as index_file:
+			pickle.dump(encoding_index, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(temp_path, TREE_ENCODING_INDEX_PATH)
+
+		if is_new and os.path.exists(".gitignore"):
+			config.add_to_git_ignore(TREE_ENCODING_INDEX_PATH)
+
+	_encoding_index_cache[source_hash] = encoding_index
+	return encoding_index
+
+def get_encoding_history() -> EncodingHistory:
+	current = get_encoding_index()
+
+	# under the append-only rule a later encoding of the same version only adds codes, so the longest one wins
+	latest_snapshots: dict[BuildVersion, tuple[int, bytes]] = {}
+	if os.path.isdir(TREE_ENCODING_SNAPSHOT_PATH):
+		for file_name in os.listdir(TREE_ENCODING_SNAPSHOT_PATH):
+			match = SNAPSHOT_NAME_PATTERN.fullmatch(file_name)
+			if match == None:
+				continue
+
+			build_version = (int(match.group(1)), int(match.group(2)), int(match.group(3)))
+			encoding_bytes = open(os.path.join(TREE_ENCODING_SNAPSHOT_PATH, file_name), "rb").read()
+			pattern_count = len(json.loads(encoding_bytes)["patterns"])
+			if not build_version in latest_snapshots or latest_snapshots[build_version][0] < pattern_count:
+				latest_snapshots[build_version] = (pattern_count, encoding_bytes)
+
+	snapshots = []
+	for build_version in sorted(latest_snapshots):
+		snapshots.append((build_version, load_encoding_index(latest_snapshots[build_version][1])))
+
+	return {"current": current, "snapshots": snapshots}
+
+def to_encoding_history(encoding: EncodingIndex | EncodingHistory) -> EncodingHistory:
+	if "current" in encoding:
+		return encoding
+	return {"current": encoding, "snapshots": []}
+
+def get_history_indices(history: EncodingHistory) -> dict[str, EncodingIndex]:
+	indices = {history["current"]["source_hash"]: history["current"]}
+	for _, encoding_index in history["snapshots"]:
+		indices[encoding_index["source_hash"]] = encoding_index
+	return indices
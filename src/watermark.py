@@ -0,0 +1,166 @@
+import os
+import json
+import sqlite3
+import hashlib
+from datetime import datetime, timezone
+import pandas as pd
+from pandas import DataFrame
+from midas.playfab import UserData
+import src.config as config
+
+WATERMARK_PATH = "midas.db"
+WATERMARK_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+def get_run_key(**params) -> str:
+	return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def to_datetime(timestamp: str) -> datetime:
+	value = pd.Timestamp(timestamp)
+	if value.tzinfo == None:
+		value = value.tz_localize(timezone.utc)
+	return value.to_pydatetime()
+
+def get_page_watermarks(page_df: DataFrame) -> dict[str, str]:
+	if len(page_df.index) == 0 or not "Timestamp" in page_df.columns:
+		return {}
+
+	timestamps = pd.to_datetime(page_df["Timestamp"], utc=True)
+	latest = timestamps.groupby(page_df["PlayFabUserId"]).max()
+
+	watermarks = {}
+	for user_id, timestamp in latest.items():
+		watermarks[str(user_id)] = timestamp.strftime(WATERMARK_FORMAT)
+	return watermarks
+
+def filter_page(page_df: DataFrame, user_watermarks: dict[str, datetime]) -> DataFrame:
+	if len(page_df.index) == 0 or len(user_watermarks) == 0:
+		return page_df
+
+	timestamps = pd.to_datetime(page_df["Timestamp"], utc=True)
+	floors = pd.to_datetime(page_df["PlayFabUserId"].map(
+		{user_id: timestamp.strftime(WATERMARK_FORMAT) for user_id, timestamp in user_watermarks.items()}
+	), utc=True)
+	return page_df[floors.isna() | (timestamps > floors)]
+
+class WatermarkStore():
+	def __init__(self, path=WATERMARK_PATH):
+		self.path = path
+		is_new = not os.path.exists(path)
+		self.connection = sqlite3.connect(path)
+		self.connection.executescript("""
+			CREATE TABLE IF NOT EXISTS user_watermarks (
+				title_id TEXT NOT NULL,
+				user_id TEXT NOT NULL,
+				timestamp TEXT NOT NULL,
+				PRIMARY KEY (title_id, user_id)
+			);
+			CREATE TABLE IF NOT EXISTS runs (
+				run_key TEXT PRIMARY KEY,
+				title_id TEXT NOT NULL,
+				out_path TEXT NOT NULL,
+				started_at TEXT NOT NULL,
+				is_complete INTEGER NOT NULL DEFAULT 0,
+				slice_key TEXT,
+				out_size INTEGER NOT NULL DEFAULT 0
+			);
+		""")
+
+		# older files have runs without the slice their pages are cached under
+		run_columns = [row[1] for row in self.connection.execute("PRAGMA table_info(runs)").fetchall()]
+		if not "slice_key" in run_columns:
+			self.connection.execute("ALTER TABLE runs ADD COLUMN slice_key TEXT")
+		if not "out_size" in run_columns:
+			self.connection.execute("ALTER TABLE runs ADD COLUMN out_size INTEGER NOT NULL DEFAULT 0")
+
+		# runs used to only record their finished users, not the users they were sampled with
+		run_user_columns = [row[1] for row in self.connection.execute("PRAGMA table_info(run_users)").fetchall()]
+		if len(run_user_columns) > 0 and not "is_complete" in run_user_columns:
+			self.connection.execute("DROP TABLE run_users")
+
+		self.connection.executescript("""
+			CREATE TABLE IF NOT EXISTS run_users (
+				run_key TEXT NOT NULL,
+				user_id TEXT NOT NULL,
+				user_index INTEGER NOT NULL,
+				event_count INTEGER NOT NULL,
+				join_timestamp TEXT NOT NULL,
+				is_complete INTEGER NOT NULL DEFAULT 0,
+				PRIMARY KEY (run_key, user_id)
+			);
+		""")
+		self.connection.commit()
+
+		if is_new and os.path.exists(".gitignore"):
+			config.add_to_git_ignore(path)
+
+	def get_if_run_incomplete(self, run_key: str) -> bool:
+		row = self.connection.execute("SELECT is_complete FROM runs WHERE run_key = ?", (run_key,)).fetchone()
+		return row != None and row[0] == 0
+
+	# the users are sampled at random, so a resumed run has to reuse the exact list it started with
+	def start_run(self, run_key: str, title_id: str, out_path: str, user_data_list: list[UserData]):
+		self.connection.execute("DELETE FROM run_users WHERE run_key = ?", (run_key,))
+		self.connection.execute(
+			"INSERT OR REPLACE INTO runs (run_key, title_id, out_path, started_at, is_complete) VALUES (?, ?, ?, ?, 0)",
+			(run_key, title_id, out_path, datetime.now(timezone.utc).strftime(WATERMARK_FORMAT))
+		)
+		self.connection.executemany(
+			"INSERT OR IGNORE INTO run_users (run_key, user_id, user_index, event_count, join_timestamp) VALUES (?, ?, ?, ?, ?)",
+			[(run_key, user_data["PlayFabUserId"], index, user_data["EventCount"], str(user_data["JoinTimestamp"])) for index, user_data in enumerate(user_data_list)]
+		)
+		self.connection.commit()
+
+	def set_run_slice_key(self, run_key: str, slice_key: str):
+		self.connection.execute("UPDATE runs SET slice_key = ? WHERE run_key = ?", (slice_key, run_key))
+		self.connection.commit()
+
+	def get_run_slice_key(self, run_key: str) -> str | None:
+		row = self.connection.execute("SELECT slice_key FROM runs WHERE run_key = ?", (run_key,)).fetchone()
+		if row == None:
+			return None
+		return row[0]
+
+	# how large the output file was when the run last committed a page
+	def get_run_out_size(self, run_key: str) -> int:
+		row = self.connection.execute("SELECT out_size FROM runs WHERE run_key = ?", (run_key,)).fetchone()
+		if row == None:
+			return 0
+		return row[0]
+
+	def get_run_user_data_list(self, run_key: str) -> list[UserData]:
+		rows = self.connection.execute(
+			"SELECT user_id, event_count, join_timestamp FROM run_users WHERE run_key = ? ORDER BY user_index",
+			(run_key,)
+		).fetchall()
+		return [{"PlayFabUserId": row[0], "EventCount": row[1], "JoinTimestamp": row[2]} for row in rows]
+
+	def finish_run(self, run_key: str):
+		self.connection.execute("UPDATE runs SET is_complete = 1 WHERE run_key = ?", (run_key,))
+		self.connection.execute("DELETE FROM run_users WHERE run_key = ?", (run_key,))
+		self.connection.commit()
+
+	def get_completed_user_ids(self, run_key: str) -> set[str]:
+		rows = self.connection.execute("SELECT user_id FROM run_users WHERE run_key = ? AND is_complete = 1", (run_key,)).fetchall()
+		return set([row[0] for row in rows])
+
+	def get_user_watermarks(self, title_id: str) -> dict[str, datetime]:
+		rows = self.connection.execute("SELECT user_id, timestamp FROM user_watermarks WHERE title_id = ?", (title_id,)).fetchall()
+		return {row[0]: to_datetime(row[1]) for row in rows}
+
+	# commits the page's watermarks and the run progress together so a crash can't leave them out of step
+	def complete_page(self, run_key: str, title_id: str, user_ids: list[str], watermarks: dict[str, str], out_size: int | None=None):
+		if out_size != None:
+			self.connection.execute("UPDATE runs SET out_size = ? WHERE run_key = ?", (out_size, run_key))
+		self.connection.executemany(
+			"UPDATE run_users SET is_complete = 1 WHERE run_key = ? AND user_id = ?",
+			[(run_key, user_id) for user_id in user_ids]
+		)
+		self.connection.executemany(
+			"""INSERT INTO user_watermarks (title_id, user_id, timestamp) VALUES (?, ?, ?)
+			ON CONFLICT (title_id, user_id) DO UPDATE SET timestamp = MAX(timestamp, excluded.timestamp)""",
+			[(title_id, user_id, timestamp) for user_id, timestamp in watermarks.items()]
+		)
+		self.connection.commit()
+
+	def close(self):
+		self.connection.close()